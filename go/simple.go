@@ -104,9 +104,9 @@ func simpleIndex(w http.ResponseWriter) {
 func simpleProject(w http.ResponseWriter, project string) {
 
 	// verify if we have the project by fetching its last_serial
-	var lastSerial int64
+	var packageID, lastSerial int64
 	var summary, version string
-	err := db.QueryRow("select last_serial,summary,version from package where name=?", project).Scan(&lastSerial, &summary, &version)
+	err := db.QueryRow("select id,last_serial,summary,version from package where name=?", project).Scan(&packageID, &lastSerial, &summary, &version)
 	if err != nil {
 		log.Printf("project %s not found", project)
 		w.WriteHeader(403)
@@ -127,7 +127,10 @@ func simpleProject(w http.ResponseWriter, project string) {
 	<h1>Links for %s</h1>
 `, project, project)
 
-	rows, err := db.Query("select release,filename,url,size,requires_python,sha256_digest from file where name=?", project)
+	rows, err := db.Query(`select r.release,f.filename,f.url,f.size,f.requires_python,f.sha256_digest
+		from release as r join file as f on f.release_id=r.id
+		where r.package_id=?
+		order by r.sort_key,f.id`, packageID)
 	if err != nil {
 		log.Println(err)
 	} else {
@@ -221,7 +224,8 @@ func main() {
 
 	var err error
 	dbPath := path.Join(*directory, "pypi.db")
-	db, err = sql.Open("sqlite3", dbPath)
+	// read-only, the database is in WAL mode: never blocked by a running pypim
+	db, err = sql.Open("sqlite3", "file:"+dbPath+"?mode=ro&_busy_timeout=5000")
 	if err != nil {
 		log.Fatal(err)
 	}
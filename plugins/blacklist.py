@@ -154,6 +154,15 @@ SCAM = [
 ]
 
 
+# packages with a classifier like ...
+CLASSIFIER_SQL = """\
+select distinct p.name
+from package as p
+join package_classifier as pc on pc.package_id=p.id
+join classifier as c on c.id=pc.classifier_id
+where c.classifier like """
+
+
 def get_blacklist(db):
     """
     """
@@ -193,26 +202,27 @@ def get_blacklist(db):
     # remove Plone (CMS), Django (web), Odoo (ERP) : too many packages
     filter(
         "Framework :: Plone",
-        "select distinct name from classifier where classifier like 'Framework :: Plone%'",
+        CLASSIFIER_SQL + "'Framework :: Plone%'",
         "select name from list_packages where name like 'Products.%' or name like 'collective.%'",
     )
 
     filter(
         "Framework :: Django",
-        "select distinct name from classifier where classifier like 'Framework :: Django'",
+        CLASSIFIER_SQL + "'Framework :: Django'",
         "select name from list_packages where name like 'django%'",
     )
 
     filter(
         "Framework :: Odoo",
-        "select distinct name from classifier where classifier like 'Framework :: Odoo'",
+        CLASSIFIER_SQL + "'Framework :: Odoo'",
         "select name from list_packages where name like 'odoo%'",
     )
 
     # remove packages without file
     filter(
         "without file",
-        "select name from package where name not in (select distinct name from file)",
+        "select name from package as p where not exists "
+        "(select 1 from release as r join file as f on f.release_id=r.id where r.package_id=p.id)",
     )
 
     # filter("description UNKNOWN", 'select name from package where description="UNKNOWN"')
@@ -1,47 +1,158 @@
+import functools
 import logging
-from packaging.version import parse, InvalidVersion
+from packaging.specifiers import SpecifierSet, InvalidSpecifier
+from packaging.version import Version, InvalidVersion
 
 
 logger = logging.getLogger("pypim")
 
 
-def parse_conditions(conditions):
+def _int_key(n):
+    """
+    encode an integer as a string that sorts numerically
+    """
+    n = str(n)
+    return f"{len(n):02d}{n}"
+
+
+def version_key(version):
+    """
+    returns a string that sorts like the PEP 440 versions
+    the invalid versions sort before the valid ones, in lexicographic order
     """
+
+    try:
+        v = Version(version)
+    except InvalidVersion:
+        return "0" + version
+
+    key = ["1", _int_key(v.epoch)]
+
+    # release, without the trailing zeros
+    release = list(v.release)
+    while release and release[-1] == 0:
+        release.pop()
+    key.extend("." + _int_key(i) for i in release)
+    key.append(" ")
+
+    # pre-release: 1.0.dev0 < 1.0a0 < 1.0
+    if v.pre is not None:
+        key.append("1" + v.pre[0] + _int_key(v.pre[1]))
+    elif v.post is None and v.dev is not None:
+        key.append("0")
+    else:
+        key.append("2")
+
+    # post-release: 1.0 < 1.0.post0
+    if v.post is None:
+        key.append("0")
+    else:
+        key.append("1" + _int_key(v.post))
+
+    # development release: 1.0.post0.dev0 < 1.0.post0
+    if v.dev is None:
+        key.append("1")
+    else:
+        key.append("0" + _int_key(v.dev))
+
+    # local version: 1.0 < 1.0+abc < 1.0+1
+    if v.local is None:
+        key.append("0")
+    else:
+        key.append("1")
+        for part in v.local.split("."):
+            if part.isdigit():
+                key.append("." + "1" + _int_key(int(part)))
+            else:
+                key.append("." + "0" + part)
+
+    return "".join(key)
+
+
+@functools.lru_cache(maxsize=None)
+def _specifier_set(specifier):
+    """
+    the parsed specifier, None if invalid
+    """
+    try:
+        return SpecifierSet(specifier)
+    except InvalidSpecifier:
+        return None
+
+
+@functools.lru_cache(maxsize=65536)
+def _version(version):
+    """
+    the parsed version, None if invalid
+    """
+    try:
+        return Version(version)
+    except InvalidVersion:
+        return None
+
+
+@functools.lru_cache(maxsize=262144)
+def _contains(specifier, version, prereleases):
+    """
+    True if the version satisfies the specifier
+
+    with prereleases=None, the pre-releases satisfy only a specifier that mentions
+    one (packaging >= 26 accepts them otherwise)
     """
+    v = _version(version)
+    if v is None:
+        return False
+    spec = _specifier_set(specifier)
+    if prereleases is None:
+        prereleases = bool(spec.prereleases)
+    return spec.contains(v, prereleases=prereleases)
 
-    mandatories = set()
+
+def parse_conditions(conditions):
+    """
+    the valid specifiers of the conditions
+    """
 
     if conditions is None:
-        return mandatories
-
-    for cond in conditions:
-        for test in cond.split(","):
-            test = test.strip()
-            test = test.replace("'", "")
-            test = test.replace('"', "")
-            if test.startswith("=="):
-                if test.find("*") == -1:
-                    try:
-                        parse(test[2:])
-                        mandatories.add(test[2:])
-                        break
-                    except InvalidVersion:
-                        # version mal ficelÃ©e
-                        pass
-
-            # try:
-            #     if t.startswith(">="): Version(t[2:])
-            #     elif t.startswith(">"): Version(t[1:])
-            #     elif t.startswith("<="): Version(t[2:])
-            #     elif t.startswith("<"): Version(t[1:])
-            #     elif t.startswith("!="): Version(t[2:])
-            #     elif t.startswith("~="): Version(t[2:])
-            #     else:
-            #         raise Exception
-            # except Exception:
-            #     print("==============", k, t)
-
-    return mandatories
+        return []
+
+    return [cond for cond in conditions if _specifier_set(cond) is not None]
+
+
+def required_releases(versions, conditions, kept):
+    """
+    the releases to keep in addition to kept so that each condition is satisfied by
+    a kept release, newest first
+
+    like pip, the pre-releases satisfy a condition only if it allows them or if no
+    final release does; the releases are chosen greedily: the newest one that
+    satisfies the most conditions
+    """
+
+    unsatisfied = []
+    for spec in parse_conditions(conditions):
+        prereleases = None
+        if not any(_contains(spec, v, None) for v in versions):
+            prereleases = True
+        if not any(_contains(spec, v, prereleases) for v in kept):
+            unsatisfied.append((spec, prereleases))
+
+    required = []
+    while unsatisfied:
+        best, best_count = None, 0
+        for v in reversed(versions):
+            count = sum(1 for spec, pre in unsatisfied if _contains(spec, v, pre))
+            if count > best_count:
+                best, best_count = v, count
+        if best is None:
+            # no release satisfies the remaining conditions
+            break
+        required.append(best)
+        unsatisfied = [
+            (spec, pre) for spec, pre in unsatisfied if not _contains(spec, best, pre)
+        ]
+
+    return required
 
 
 class LatestReleaseFilter:
@@ -51,11 +162,18 @@ class LatestReleaseFilter:
 
     name = "latest_release"
     keep = 0  # by default, keep 'em all
+    only_required = False  # keep only the releases required by the conditions
 
     def initialize_plugin(self):
         """
         Initialize the plugin reading patterns from the config.
         """
+        self.only_required = bool(
+            self.configuration.get("latest_release", {}).get("only_required")
+        )
+        if self.only_required:
+            logger.info("Initialized latest releases plugin with required releases")
+
         if self.keep:
             return
 
@@ -71,35 +189,41 @@ class LatestReleaseFilter:
     def filter(self, info, releases, conditions, removed_desc):
         """
         Keep the latest releases
-        """
 
-        if self.keep == 0:
-            return removed_desc
+        releases are ordered by version (see version_key)
 
-        mandatories = parse_conditions(conditions)
+        if only_required, keep only the releases needed by the conditions, or the
+        current version if there is none (package required without specifier)
+        """
 
         versions = list(releases.keys())
         before = len(versions)
+        current_version = info.get("version")
 
-        if before <= self.keep:
-            # not enough releases: do nothing
-            return
+        if self.only_required:
+            latest = required_releases(versions, conditions, [])
+            if not latest and versions:
+                if current_version in releases:
+                    latest = [current_version]
+                else:
+                    latest = versions[-1:]
 
-        versions_pair = sorted(map(lambda v: (parse(v), v), versions), reverse=True)
+        else:
+            if self.keep == 0:
+                return removed_desc
 
-        latest = list()
-        for i, v in enumerate(versions_pair):
-            v = v[1]
-            if i < self.keep:
-                latest.append(v)
-            else:
-                if v in mandatories:
-                    latest.append(v)
+            if before <= self.keep:
+                # not enough releases: do nothing
+                return
 
-        current_version = info.get("version")
-        if current_version and (current_version not in latest):
-            # never remove the stable/official version
-            latest[0] = current_version
+            latest = versions[: -self.keep - 1 : -1]
+
+            if current_version and (current_version not in latest):
+                # never remove the stable/official version
+                latest[0] = current_version
+
+            # the releases needed by the dependants of the package
+            latest.extend(required_releases(versions, conditions, latest))
 
         after = len(latest)
         latest = set(latest)
@@ -7,23 +7,44 @@ PyPIM: PyPI.org Intelligent Mirroring
 
 import xmlrpc.client
 import json
+from array import array
 import sqlite3
 import click
+import codecs
+import contextlib
+import email.utils
+import functools
+import hashlib
 import logging
 import sys
 import time
 import requests
+import urllib3
 import signal
-from collections import defaultdict
-from packaging.version import parse
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from packaging.markers import Marker, UndefinedComparison, UndefinedEnvironmentName
+from packaging.requirements import InvalidRequirement, Requirement
+from packaging.version import InvalidVersion
 from packaging.utils import canonicalize_name  # lowercase, only hyphen PEP503
 from html import escape
 import pathlib
 import re
 import pickle
+import random
+import struct
+import tempfile
+import zlib
 from datetime import timedelta
 from urllib.parse import urlparse
 from plugins import filename_name, latest_name
+from plugins.latest_name import version_key
 from plugins.blacklist import get_blacklist
 import shutil
 import humanfriendly as hf
@@ -33,6 +54,34 @@ import os.path
 # create logger for our app
 logger = logging.getLogger("pypim")
 
+# maximum age of the list of packages before a full refresh (seconds)
+FULL_REFRESH_PERIOD = 7 * 86400
+
+# JSON metadata larger than this is spooled to a temporary file and parsed incrementally
+LARGE_DOCUMENT = 8 * 1024 * 1024
+
+# timeouts of the HTTP requests (seconds): to connect, and between two received bytes
+HTTP_TIMEOUT = (10, 60)
+
+# a transfer slower than MIN_THROUGHPUT (bytes/s) over STALL_PERIOD (s) is stalled
+MIN_THROUGHPUT = 1024
+STALL_PERIOD = 30
+
+# delay before the retries of an HTTP request (seconds): exponential, with jitter
+BACKOFF_BASE = 2
+BACKOFF_MAX = 120
+
+# maximum size of the files queued or being downloaded
+DOWNLOAD_MAX_BYTES = 256 * 1024 * 1024
+
+# period of the progress messages of the downloads (seconds)
+PROGRESS_PERIOD = 30
+
+# the environments of the clients of the mirror (see TargetEnvironments)
+# the platforms excluded by ExcludePlatformFilter are not targeted
+TARGET_PYTHONS = ("3.8", "3.9", "3.10", "3.11", "3.12")
+TARGET_MACHINES = ("x86_64",)
+
 
 class ColoredFormatter(logging.Formatter):
 
@@ -166,14 +215,52 @@ class CtrlC:
         return self.ctrl_c
 
 
-def insert_row(cur, table, row):
+# pragmas of the database connections, by role
+CONNECTION_PROFILES = {
+    # the synchronization: one writer with large transactions
+    "writer": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",  # durable enough in WAL mode
+        "journal_size_limit": 1 << 26,  # truncate the log after a checkpoint
+        "cache_size": -262144,  # 256 MiB
+        "mmap_size": 1 << 30,
+        "temp_store": "MEMORY",
+    },
+    # the HTTP servers: many small queries, never blocked by the writer in WAL mode
+    "reader": {
+        "query_only": 1,
+        "cache_size": -65536,  # 64 MiB
+        "mmap_size": 1 << 30,
+        "temp_store": "MEMORY",
+    },
+}
+
+
+def connect(path, role="writer", **kwargs):
+    """
+    open the database with the profile of the given role
+    """
+
+    if role == "reader":
+        db = sqlite3.connect(f"file:{path}?mode=ro", uri=True, **kwargs)
+    else:
+        db = sqlite3.connect(path, **kwargs)
+
+    for pragma, value in CONNECTION_PROFILES[role].items():
+        db.execute(f"pragma {pragma}={value}")
+
+    return db
+
+
+def checkpoint(db, mode="PASSIVE"):
     """
-    insert a dict into a SQLite3 table
+    copy the content of the write-ahead log into the database
     """
-    columns = ",".join(row.keys())
-    placeholders = ":" + ",:".join(row.keys())
-    query = f"insert into {table} ({columns}) values ({placeholders})"
-    cur.execute(query, row)
+
+    busy, log, checkpointed = db.execute(f"pragma wal_checkpoint({mode})").fetchone()
+    logger.debug(
+        f"checkpoint {mode}: busy={busy} log={log} checkpointed={checkpointed}"
+    )
 
 
 def fetch_value(db, sql, params=(), default_value=0):
@@ -201,45 +288,171 @@ def get_meta_db_path(db):
             return f.as_posix()
 
 
-def create_db(db, use_meta_db):
+class MetadataCodec:
     """
-    initalize the both databases
-        db          decoded metadata into SQL tables
-        db_json     the raw metadata in JSON format
+    compression of the raw JSON metadata with a dictionary shared by all documents
+
+    format of the blobs:
+        {...}                           uncompressed JSON (previous versions)
+        \\x00 <dictionary id> <zlib>     compressed, dictionary id is a 32-bit integer,
+                                        0 means no dictionary
     """
 
-    if use_meta_db:
-        db.execute("attach database ? as meta_db", (get_meta_db_path(db),))
-        db.executescript(
-            """\
--- package JSON metadata
-create table if not exists meta_db.package (
-    name            text not null primary key,
-    last_serial     integer not null,
-    metadata        blob
-);
-"""
+    # JSON members with a short value, and short list items
+    TOKENS = rb'(?:, |\{|\[)?"[^"]{1,64}": (?:"[^"]{0,64}"|[-\w.]+|\{|\[)|"[^"]{1,80}"(?:, |\]|\})'
+    MAGIC = b"\x00"
+    HEADER = struct.Struct(">I")
+
+    def __init__(self, db, schema="meta_db"):
+        self.db = db
+        self.schema = schema
+        self.dictionaries = {0: b""}
+        self.dictionary_id = fetch_value(
+            db, f"select max(id) from {schema}.dictionary", default_value=0
         )
-        db.execute("detach database meta_db")
 
-    db.executescript(
-        """\
--- response of changelog_last_serial()
-create table if not exists pypi_last_serial (
-    last_serial     integer not null,
-    timestamp       integer
-);
+    def dictionary(self, dictionary_id):
+        if dictionary_id not in self.dictionaries:
+            row = self.db.execute(
+                f"select data from {self.schema}.dictionary where id=?",
+                (dictionary_id,),
+            ).fetchone()
+            if row is None:
+                raise ValueError(f"unknown compression dictionary {dictionary_id}")
+            self.dictionaries[dictionary_id] = row[0]
+        return self.dictionaries[dictionary_id]
+
+    def _compressor(self):
+        if self.dictionary_id:
+            return zlib.compressobj(9, zdict=self.dictionary(self.dictionary_id))
+        return zlib.compressobj(9)
+
+    def compress(self, data):
+        z = self._compressor()
+        return (
+            self.MAGIC
+            + self.HEADER.pack(self.dictionary_id)
+            + z.compress(data)
+            + z.flush()
+        )
 
--- response of list_packages_with_serial
-create table if not exists list_packages (
-    name            text not null primary key,
-    last_serial     integer not null,
-    ignore          boolean
-);
+    def compress_file(self, src, dst, chunk_size=1 << 16):
+        """
+        compress the binary file src into the binary file dst
+        """
+        z = self._compressor()
+        dst.write(self.MAGIC + self.HEADER.pack(self.dictionary_id))
+        while True:
+            chunk = src.read(chunk_size)
+            if not chunk:
+                break
+            dst.write(z.compress(chunk))
+        dst.write(z.flush())
+
+    def decompress(self, blob):
+        if blob is None or blob[:1] != self.MAGIC:
+            return blob
+        (dictionary_id,) = self.HEADER.unpack_from(blob, 1)
+        if dictionary_id:
+            z = zlib.decompressobj(zdict=self.dictionary(dictionary_id))
+        else:
+            z = zlib.decompressobj()
+        return z.decompress(blob[1 + self.HEADER.size :]) + z.flush()
+
+    def train(self, samples, size=32768):
+        """
+        build a new dictionary from sample documents and use it for compression
+
+        zlib uses the last 32 KiB of the dictionary, the most frequent strings go last
+        """
+
+        tokens = defaultdict(int)
+        for data in samples:
+            # keys, short values and their separators, counted once per document
+            for token in set(re.findall(self.TOKENS, data)):
+                tokens[token] += 1
+
+        # keep the strings found in several documents, most valuable first
+        scored = sorted(
+            (token for token, count in tokens.items() if count > 1),
+            key=lambda token: tokens[token] * len(token),
+            reverse=True,
+        )
+        dictionary = []
+        length = 0
+        for token in scored:
+            if length + len(token) > size:
+                break
+            dictionary.append(token)
+            length += len(token)
+        dictionary = b"".join(reversed(dictionary))
+
+        cur = self.db.execute(
+            f"insert into {self.schema}.dictionary (data) values (?)", (dictionary,)
+        )
+        self.dictionary_id = cur.lastrowid
+        self.dictionaries[self.dictionary_id] = dictionary
+        logger.info(
+            f"compression dictionary {self.dictionary_id}: {len(dictionary)} bytes"
+        )
 
+    def sample(self, count=1000):
+        """
+        returns a random sample of the stored documents
+        """
+        rows = self.db.execute(
+            f"select metadata from {self.schema}.package order by random() limit ?",
+            (count,),
+        )
+        return [self.decompress(blob) for blob, in rows]
+
+
+# columns filled from the JSON metadata
+PACKAGE_COLUMNS = (
+    "name",
+    "last_serial",
+    "author",
+    "author_email",
+    "bugtrack_url",
+    "description",
+    "description_content_type",
+    "docs_url",
+    "download_url",
+    "home_page",
+    "keywords",
+    "license",
+    "maintainer",
+    "maintainer_email",
+    "package_url",
+    "platform",
+    "project_url",
+    "release_url",
+    "requires_python",
+    "summary",
+    "version",
+)
+
+FILE_COLUMNS = (
+    "comment_text",
+    "filename",
+    "has_sig",
+    "sha256_digest",
+    "packagetype",
+    "python_version",
+    "requires_python",
+    "size",
+    "upload_time",
+    "upload_time_iso_8601",
+    "url",
+)
+
+# the tables filled from the JSON metadata
+# the cascades are done by triggers: foreign_keys pragma is off by default
+CATALOG_SCHEMA = """\
 -- package info
 create table if not exists package (
-    name            text not null primary key,
+    id              integer primary key,
+    name            text not null unique,
     last_serial     number not null,
     author          text,
     author_email    text,
@@ -266,28 +479,42 @@ create table if not exists package (
     version         text
 );
 
--- classifiers of a package
+-- dictionary of the classifiers
 create table if not exists classifier (
-    name        text not null,
-    classifier  text not null
+    id          integer primary key,
+    classifier  text not null unique
 );
 
--- requirements of a package
+-- classifiers of a package
+create table if not exists package_classifier (
+    package_id      integer not null references package (id) on delete cascade,
+    classifier_id   integer not null references classifier (id),
+    primary key (package_id, classifier_id)
+) without rowid;
+
+-- requirements of a package, parsed by parse_requirement
 create table if not exists requires_dist (
-    name            text not null,
-    requires_dist   text not null
+    package_id      integer not null references package (id) on delete cascade,
+    requires_dist   text not null,
+    name            text,               -- canonical name of the dependency
+    specifier       text,
+    marker          text,
+    extra           text,               -- extra of the package needing the dependency
+    error           integer not null default 0  -- invalid requirement
 );
 
 -- releases of a package
 create table if not exists release (
-    name        text not null,
-    release     text not null
+    id          integer primary key,
+    package_id  integer not null references package (id) on delete cascade,
+    release     text not null,
+    sort_key    text                -- version_key(release)
 );
 
 -- files of a release
 create table if not exists file (
-    name            text not null,
-    release         text not null,
+    id              integer primary key,
+    release_id      integer not null references release (id) on delete cascade,
     comment_text    text,
     -- digests md5 sha256
     -- "downloads": -1
@@ -304,225 +531,1337 @@ create table if not exists file (
     url             text
 );
 
+-- data derived from the catalog (see get_requirements)
+create table if not exists derived_data (
+    key             text not null primary key,
+    serial          integer not null,       -- max(last_serial) of the catalog
+    fingerprint     text not null,          -- of the configuration
+    data            blob not null           -- pickled
+);
+
+-- changes of the catalog since the last get_requirements, logged by triggers
+-- only when there are derived data to update
+create table if not exists package_change (
+    name            text not null primary key
+) without rowid;
+
+create table if not exists requirement_change (
+    package         text not null,
+    name            text not null,      -- canonical name of the dependency
+    specifier       text not null,
+    marker          text,
+    delta           integer not null    -- 1 added, -1 removed
+);
+
 -- indexes
 create unique index if not exists package_uk on package (name,last_serial);
-create unique index if not exists release_pk on release (name,release);
-create index if not exists release_fk on release (name);
-create index if not exists file_fk on file (name,release);
+create index if not exists requires_dist_fk on requires_dist (package_id);
+create index if not exists requires_dist_name on requires_dist (name);
+create unique index if not exists release_uk on release (package_id,release);
+create index if not exists release_sort on release (package_id,sort_key);
+create index if not exists file_fk on file (release_id);
 create unique index if not exists file_url on file (url);
 
 -- triggers
-create trigger if not exists classifier_trigger
+create trigger if not exists package_trigger
     after delete on package for each row
     begin
-        delete from classifier where old.name=name;
+        delete from package_classifier where package_id=old.id;
+        delete from requires_dist where package_id=old.id;
+        delete from release where package_id=old.id;
     end;
 
-create trigger if not exists requires_dist_trigger
-    after delete on package for each row
+-- no "insert or ignore" here: the conflict policy of the upsert on package applies
+create trigger if not exists package_insert_trigger
+    after insert on package for each row
+    when exists (select 1 from derived_data where key='requirements')
     begin
-        delete from requires_dist where old.name=name;
+        insert into package_change (name) select new.name
+            where not exists (select 1 from package_change where name=new.name);
     end;
 
-create trigger if not exists release_trigger
-    after delete on package for each row
+create trigger if not exists package_update_trigger
+    after update of last_serial on package for each row
+    when exists (select 1 from derived_data where key='requirements')
     begin
-        delete from release where old.name=name;
+        insert into package_change (name) select new.name
+            where not exists (select 1 from package_change where name=new.name);
     end;
 
-create trigger if not exists file_trigger
-    after delete on package for each row
+-- the requirements of a deleted package are logged here: they are deleted after it
+create trigger if not exists package_delete_trigger
+    before delete on package for each row
+    when exists (select 1 from derived_data where key='requirements')
+    begin
+        insert into package_change (name) select old.name
+            where not exists (select 1 from package_change where name=old.name);
+        insert into requirement_change (package,name,specifier,marker,delta)
+            select old.name,name,specifier,marker,-1 from requires_dist
+            where package_id=old.id and error=0 and extra is null
+              and specifier is not null;
+    end;
+
+create trigger if not exists requires_dist_insert_trigger
+    after insert on requires_dist for each row
+    when new.error=0 and new.extra is null and new.specifier is not null
+      and exists (select 1 from derived_data where key='requirements')
+    begin
+        insert into requirement_change (package,name,specifier,marker,delta)
+            select name,new.name,new.specifier,new.marker,1 from package
+            where id=new.package_id;
+    end;
+
+create trigger if not exists requires_dist_delete_trigger
+    after delete on requires_dist for each row
+    when old.error=0 and old.extra is null and old.specifier is not null
+      and exists (select 1 from derived_data where key='requirements')
+    begin
+        insert into requirement_change (package,name,specifier,marker,delta)
+            select name,old.name,old.specifier,old.marker,-1 from package
+            where id=old.package_id;
+    end;
+
+create trigger if not exists release_trigger
+    after delete on release for each row
     begin
-        delete from file where old.name=name;
+        delete from file where release_id=old.id;
     end;
 
+-- files with the name of their package and release
+create view if not exists package_file as
+    select p.name, r.release, f.*
+    from package as p
+    join release as r on r.package_id=p.id
+    join file as f on f.release_id=r.id;
+"""
+
+
+# the extras in a marker, as written by packaging
+EXTRA_MARKER = re.compile(r'\bextra == "([^"]*)"')
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_requirement(requirement):
+    """
+    parse a requires_dist: (canonical name, specifier, marker, extra, error)
+
+    extra is the extra of the package that needs the dependency, from the marker
+    an invalid requirement has error=1 and the name found at its start, if any
+    """
+
+    try:
+        req = Requirement(requirement)
+    except InvalidRequirement:
+        m = re.match(r"\s*([A-Za-z0-9][A-Za-z0-9._-]*)", requirement)
+        name = canonicalize_name(m.group(1)) if m else None
+        return name, None, None, None, 1
+
+    marker = str(req.marker) if req.marker else None
+    extra = ",".join(EXTRA_MARKER.findall(marker)) if marker else None
+    return (
+        canonicalize_name(req.name),
+        str(req.specifier) or None,
+        marker,
+        extra or None,
+        0,
+    )
+
+
+def migrate_v1(db):
+    """
+    index the name of classifier and requires_dist (used by the delete triggers)
+    """
+    db.executescript(
+        """\
+create index if not exists classifier_fk on classifier (name);
+create index if not exists requires_dist_fk on requires_dist (name);
 """
     )
-    logger.debug("packages database initialized")
 
 
-def delete_package(cur, name, use_meta_db):
+def migrate_v2(db):
     """
-    delete a package from all the tables
+    integer keys for package, release and file, dictionary of classifiers
+
+    the migration is a single transaction, committed by migrate_db with the new
+    version: an interrupted migration is rolled back and done again by the next run
     """
 
-    cur.execute("delete from package where name=?", (name,))
-    if use_meta_db:
-        cur.execute("delete from meta_db.package where name=?", (name,))
+    package_columns = ",".join(PACKAGE_COLUMNS)
+    file_columns = ",".join(FILE_COLUMNS)
+
+    db.executescript(
+        f"""\
+begin;
+
+drop trigger if exists classifier_trigger;
+drop trigger if exists requires_dist_trigger;
+drop trigger if exists release_trigger;
+drop trigger if exists file_trigger;
+
+drop index if exists package_uk;
+drop index if exists release_pk;
+drop index if exists release_fk;
+drop index if exists classifier_fk;
+drop index if exists requires_dist_fk;
+drop index if exists file_fk;
+drop index if exists file_url;
+
+alter table package rename to package_v1;
+alter table classifier rename to classifier_v1;
+alter table requires_dist rename to requires_dist_v1;
+alter table release rename to release_v1;
+alter table file rename to file_v1;
+
+{CATALOG_SCHEMA}
+
+insert into package ({package_columns})
+    select {package_columns} from package_v1;
+
+insert or ignore into classifier (classifier)
+    select classifier from classifier_v1;
+
+insert into package_classifier (package_id,classifier_id)
+    select distinct p.id,c.id
+    from classifier_v1 as o
+    join package as p on p.name=o.name
+    join classifier as c on c.classifier=o.classifier;
+
+insert into requires_dist (package_id,requires_dist)
+    select p.id,o.requires_dist
+    from requires_dist_v1 as o
+    join package as p on p.name=o.name;
+
+insert into release (package_id,release)
+    select p.id,o.release
+    from release_v1 as o
+    join package as p on p.name=o.name;
+
+insert into file (release_id,{file_columns})
+    select r.id,{",".join("o." + i for i in FILE_COLUMNS)}
+    from file_v1 as o
+    join package as p on p.name=o.name
+    join release as r on r.package_id=p.id and r.release=o.release;
+
+drop table file_v1;
+drop table release_v1;
+drop table requires_dist_v1;
+drop table classifier_v1;
+drop table package_v1;
+"""
+    )
+
+    logger.info("run VACUUM to reclaim the space of the previous tables")
 
 
-def add_package(db, orig_name, data, use_meta_db):
+def migrate_v3(db):
     """
-    add a package from the JSON metadata
+    add the version sort key to the releases
     """
 
-    metadata = json.loads(data)
+    columns = [row[1] for row in db.execute("pragma table_info(release)")]
+    if "sort_key" not in columns:
+        db.execute("alter table release add column sort_key text")
 
-    cur = db.cursor()
+    db.create_function("version_key", 1, version_key, deterministic=True)
+    db.execute(
+        "update release set sort_key=version_key(release) where sort_key is null"
+    )
+    db.execute(
+        "create index if not exists release_sort on release (package_id,sort_key)"
+    )
 
-    info = metadata["info"]
-    name = info["name"]
 
-    if name != orig_name:
-        logger.eror(f"{name} != {orig_name}")
-        assert name == orig_name
+def migrate_v4(db):
+    """
+    parse the requirements of the packages
+    """
 
-    delete_package(cur, name, use_meta_db)
+    columns = [row[1] for row in db.execute("pragma table_info(requires_dist)")]
+    for column, kind in (
+        ("name", "text"),
+        ("specifier", "text"),
+        ("marker", "text"),
+        ("extra", "text"),
+        ("error", "integer not null default 0"),
+    ):
+        if column not in columns:
+            db.execute(f"alter table requires_dist add column {column} {kind}")
+
+    rows = db.execute("select rowid,requires_dist from requires_dist").fetchall()
+    db.executemany(
+        "update requires_dist set name=?,specifier=?,marker=?,extra=?,error=? where rowid=?",
+        ((*parse_requirement(dist), rowid) for rowid, dist in rows),
+    )
+    db.execute("create index if not exists requires_dist_name on requires_dist (name)")
 
-    classifiers = info["classifiers"]
-    requires_dist = info["requires_dist"]
 
-    del info["classifiers"]
-    del info["downloads"]  # unused
-    del info["project_urls"]  # unused
-    del info["requires_dist"]
+# the schema upgrades, the version of the schema is the number of migrations
+MIGRATIONS = [migrate_v1, migrate_v2, migrate_v3, migrate_v4]
 
-    # ajoute le last_serial (plutôt que dans une table séparée)
-    last_serial = metadata["last_serial"]
-    info["last_serial"] = last_serial
+SCHEMA_VERSION = len(MIGRATIONS)
 
-    # add the package
-    insert_row(cur, "package", info)
 
-    # add classifiers
-    row = dict({"name": name})
-    for classifier in classifiers:
-        row["classifier"] = classifier
-        insert_row(cur, "classifier", row)
+def migrate_db(db):
+    """
+    upgrade an existing database to the current version of the schema
+    """
 
-    # add requirements
-    if requires_dist:
-        row = dict({"name": name})
-        for dist in requires_dist:
-            row["requires_dist"] = dist
-            insert_row(cur, "requires_dist", row)
+    version = fetch_value(db, "pragma user_version")
+    exists = fetch_value(
+        db, "select count(*) from sqlite_master where type='table' and name='package'"
+    )
 
-    for release, files in metadata["releases"].items():
+    if exists:
+        for i in range(version, SCHEMA_VERSION):
+            migration = MIGRATIONS[i]
+            logger.info(
+                f"migrate database to version {i + 1}: {migration.__doc__.strip()}"
+            )
+            start_time = time.monotonic()
+            migration(db)
+            db.execute(f"pragma user_version={i + 1}")
+            db.commit()
+            logger.info(f"migration done in {time.monotonic() - start_time:.1f}s")
 
-        # add release
-        insert_row(cur, "release", {"name": name, "release": release})
+    if version != SCHEMA_VERSION:
+        db.execute(f"pragma user_version={SCHEMA_VERSION}")
 
-        # add distribution files
-        for file in files:
-            file["name"] = name
-            file["release"] = release
 
-            # we need only the SHA256 digest
-            file["sha256_digest"] = file["digests"]["sha256"]
+def create_db(db, use_meta_db):
+    """
+    initalize the both databases
+        db          decoded metadata into SQL tables
+        db_json     the raw metadata in JSON format
 
-            # we don't care about these fields
-            del file["digests"]
-            del file["downloads"]
-            del file["md5_digest"]
+    an existing database is upgraded to the current schema
+    """
 
-            insert_row(cur, "file", file)
+    migrate_db(db)
 
-    # store the raw JSON
     if use_meta_db:
-        cur.execute(
-            "insert into meta_db.package (name,last_serial,metadata) values (?,?,?)",
-            (name, last_serial, data),
+        db.execute("attach database ? as meta_db", (get_meta_db_path(db),))
+        db.execute("pragma meta_db.journal_mode=WAL")
+        db.executescript(
+            """\
+-- package JSON metadata, compressed (see MetadataCodec)
+create table if not exists meta_db.package (
+    name            text not null primary key,
+    last_serial     integer not null,
+    metadata        blob
+);
+
+-- compression dictionaries of the JSON metadata
+create table if not exists meta_db.dictionary (
+    id              integer primary key,
+    data            blob not null
+);
+"""
         )
+        db.execute("detach database meta_db")
+
+    db.executescript(
+        """\
+-- response of changelog_last_serial()
+create table if not exists pypi_last_serial (
+    last_serial     integer not null,
+    timestamp       integer
+);
+
+-- state of the synchronization (key/value)
+create table if not exists sync_state (
+    key             text not null primary key,
+    value
+);
+
+-- response of list_packages_with_serial
+create table if not exists list_packages (
+    name            text not null primary key,
+    last_serial     integer not null,
+    ignore          boolean
+);
+create index if not exists list_packages_serial on list_packages (last_serial);
+
+-- packages mirrored by download_packages, with the fingerprint of their filters
+create table if not exists mirrored_package (
+    name            text not null primary key,
+    last_serial     integer not null,
+    fingerprint     text not null
+) without rowid;
+
+-- packages processed by the current mirroring pass (see get_progress)
+create table if not exists progress (
+    name            text not null primary key
+) without rowid;
 
-    cur.close()
+-- state of the index.html pages: serial of the package, digest of its local files
+create table if not exists simple_index (
+    name            text not null primary key,
+    last_serial     integer not null,
+    digest          text not null
+) without rowid;
+
+-- files of the mirror, path relative to the web root (see rescan_local_files)
+create table if not exists local_file (
+    path            text not null primary key,
+    size            integer not null,
+    sha256          text,               -- verified digest, null if unknown
+    mtime           real
+) without rowid;
 
-    logger.debug(f"package added: {name} {last_serial}")
+"""
+    )
+    db.executescript(CATALOG_SCHEMA)
+    logger.debug("packages database initialized")
 
 
-def update_list(client, db, clear_ignore=False):
+# statements of BulkWriter, in order of execution
+# the rows refer to their package and release by name, resolved by the unique indexes
+# releases and files are deleted last: a file moved from a removed release is updated
+# before the release and its remaining files are deleted
+BULK_STATEMENTS = {
+    "delete_package_classifier": """\
+delete from package_classifier
+where package_id=(select id from package where name=?)
+  and classifier_id=(select id from classifier where classifier=?)""",
+    "delete_requires_dist": """\
+delete from requires_dist where package_id=(select id from package where name=?)""",
+    "package": f"""\
+insert into package ({",".join(PACKAGE_COLUMNS)})
+values ({",".join("?" * len(PACKAGE_COLUMNS))})
+on conflict (name) do update
+set {",".join(f"{i}=excluded.{i}" for i in PACKAGE_COLUMNS[1:])}""",
+    "classifier": "insert or ignore into classifier (classifier) values (?)",
+    "package_classifier": """\
+insert or ignore into package_classifier (package_id,classifier_id)
+select p.id,c.id from package as p,classifier as c where p.name=? and c.classifier=?""",
+    "requires_dist": """\
+insert into requires_dist (package_id,requires_dist,name,specifier,marker,extra,error)
+select id,?,?,?,?,?,? from package where name=?""",
+    "release": """\
+insert into release (package_id,release,sort_key)
+select id,?,? from package where name=?""",
+    "file": f"""\
+insert into file (release_id,{",".join(FILE_COLUMNS)})
+select r.id,{",".join("?" * len(FILE_COLUMNS))}
+from release as r join package as p on p.id=r.package_id
+where p.name=? and r.release=?""",
+    "update_file": f"""\
+update file
+set {",".join(f"{i}=?" for i in FILE_COLUMNS)},
+    release_id=(select r.id from release as r join package as p on p.id=r.package_id
+                where p.name=? and r.release=?)
+where url=?""",
+    "delete_release": """\
+delete from release
+where package_id=(select id from package where name=?) and release=?""",
+    "delete_file": "delete from file where url=?",
+    "meta_db.package": """\
+insert or replace into meta_db.package (name,last_serial,metadata) values (?,?,?)""",
+}
+
+
+class BulkWriter:
     """
-    download and update the list of packages with their last_serial
+    accumulate the changes of packages and apply them with one executemany per statement
+
+    usage:
+        bulk = BulkWriter(db)
+        <loop>
+            add_package(db, name, data, use_meta_db, bulk)
+        for name, e in bulk.flush():
+            <handle the error>
     """
 
-    db_serial = fetch_value(db, "select last_serial from pypi_last_serial")
-    logger.info(f"db serial: {db_serial}")
+    def __init__(self, db, max_rows=50000):
+        self.db = db
+        self.max_rows = max_rows
+        self.packages = []
+        self.names = set()
+        self.count = 0
+        self.errors = []
 
-    # ----- changelog_last_serial -----
-    last_serial_time = int(time.time())
-    last_serial = client.changelog_last_serial()
-    logger.info(f"server serial: {last_serial}")
+    def add(self, name, rows):
+        """
+        add the rows of a package: a dict statement -> list of tuples
+        """
+        self.packages.append((name, rows))
+        self.names.add(name)
+        self.count += sum(len(i) for i in rows.values())
 
-    if last_serial == db_serial:
-        logger.info("database is up to date")
-    else:
-        # the server serial is different from ours: we have to update
+    def pending(self, name):
+        return name in self.names
 
-        logger.info(f"update events: {last_serial - db_serial}")
-        db.execute("delete from pypi_last_serial")
-        db.execute(
-            "insert into pypi_last_serial (last_serial, timestamp) values (?,?)",
-            (last_serial, last_serial_time),
-        )
+    def full(self):
+        return self.count >= self.max_rows
 
-        # ----- list_packages_with_serial -----
-        packages = client.list_packages_with_serial()
-        logger.info("packages listed: %d", len(packages))
-
-        ignore_flags = defaultdict(lambda: False)
-        if not clear_ignore:
-            # fetch the ignore flags
-            # for packages not modified since the last update
-            for row in db.execute(
-                "select name,ignore from list_packages where last_serial<=?",
-                (db_serial,),
-            ):
-                ignore_flags[row[0]] = row[1]
-
-        # replace the list of packages with the fresh one, ignore flag preserved
-        logger.info("refill table list_packages")
-        db.execute("delete from list_packages")
-        db.executemany(
-            "insert into list_packages (name,last_serial,ignore) values (?,?,?)",
-            [
-                (name, last_serial, ignore_flags[name])
-                for name, last_serial in packages.items()
-            ],
-        )
+    def _execute(self, packages):
+        for statement, sql in BULK_STATEMENTS.items():
+            rows = [row for _, p in packages for row in p.get(statement, ())]
+            if rows:
+                self.db.executemany(sql, rows)
 
-        # print the list of updated packages
-        for row in db.execute(
-            "select name from list_packages where last_serial>?", (db_serial,)
-        ):
-            name = row[0]
-            logger.debug(f"updated: {name}")
+    def flush(self):
+        """
+        apply the pending rows, returns the list of (name, exception) of failed packages
+        """
+        self.apply()
+        errors = self.errors
+        self.errors = []
+        return errors
 
-        updated = fetch_value(
-            db, "select count(*) from list_packages where last_serial>?", db_serial
-        )
-        logger.info(f"updated: {updated}")
+    def apply(self):
+        """
+        apply the pending rows, the failed packages are kept for flush()
+        """
+        if not self.packages:
+            return
 
-    # print some stats
-    total = fetch_value(db, "select count(*) from list_packages")
-    logger.info(f"packages: {total}")
+        self.db.execute("savepoint bulk_writer")
+        try:
+            self._execute(self.packages)
+        except sqlite3.DatabaseError:
+            # retry package by package to find the culprits
+            self.db.execute("rollback to bulk_writer")
+            for name, rows in self.packages:
+                self.db.execute("savepoint bulk_package")
+                try:
+                    self._execute([(name, rows)])
+                except sqlite3.DatabaseError as e:
+                    self.db.execute("rollback to bulk_package")
+                    self.errors.append((name, e))
+                self.db.execute("release bulk_package")
+        self.db.execute("release bulk_writer")
+
+        self.packages = []
+        self.names = set()
+        self.count = 0
 
-    ignored = fetch_value(db, "select count(*) from list_packages where ignore=1")
-    logger.info(f"ignored: {ignored}")
 
-    db.commit()
+def delete_package(cur, name, use_meta_db):
+    """
+    delete a package from all the tables
+    """
+
+    cur.execute("delete from package where name=?", (name,))
+    if use_meta_db:
+        cur.execute("delete from meta_db.package where name=?", (name,))
 
 
-def download_metadata(db, use_meta_db, pypi_uri, whitelist_cond=None):
+def _text_affinity(value):
     """
-    download and parse JSON metadata
+    the value as stored in a text column (booleans and integers become strings)
+    """
+    if isinstance(value, (bool, int)):
+        return str(int(value))
+    return value
 
-    only needed (missing and updated) packages will be downloaded
 
-    the raw JSON metadata is stored into a separated database, attached to db
-    the metadata is parsed and stored into tables of db
+def file_row(file):
     """
+    the values of FILE_COLUMNS for a file of the JSON metadata, as stored in the database
+    """
+    return tuple(
+        file.get(i) if i == "size" else _text_affinity(file.get(i))
+        for i in FILE_COLUMNS
+    )
 
-    if use_meta_db:
-        db.execute("attach database ? as meta_db", (get_meta_db_path(db),))
 
-    # update metadata only from whitelist
-    if whitelist_cond:
-        whitelist = set()
-        canonicalize_named_names = dict(
-            (canonicalize_name(name), name)
-            for name, in db.execute("select name from list_packages")
+def stored_package(db, name):
+    """
+    returns the classifiers, requirements, releases and files (by url) of a package
+    or None if the package is unknown
+    """
+
+    package_id = fetch_value(db, "select id from package where name=?", name, None)
+    if package_id is None:
+        return None
+
+    classifiers = set(
+        classifier
+        for classifier, in db.execute(
+            "select c.classifier from package_classifier as pc "
+            "join classifier as c on c.id=pc.classifier_id where pc.package_id=?",
+            (package_id,),
         )
-        for cond in whitelist_cond:
-            m = re.match(r"^([^=<>~]+)(.*)?$", cond)
+    )
+
+    requires_dist = [
+        dist
+        for dist, in db.execute(
+            "select requires_dist from requires_dist where package_id=? order by rowid",
+            (package_id,),
+        )
+    ]
+
+    releases = set(
+        release
+        for release, in db.execute(
+            "select release from release where package_id=?", (package_id,)
+        )
+    )
+
+    files = dict()
+    sql = f"""\
+select r.release,{",".join("f." + i for i in FILE_COLUMNS)}
+from release as r join file as f on f.release_id=r.id
+where r.package_id=?
+"""
+    for row in db.execute(sql, (package_id,)):
+        files[row[-1]] = (row[1:], row[0])
+
+    return classifiers, requires_dist, releases, files
+
+
+class JSONStream:
+    """
+    incremental reader of a JSON document from a binary file
+
+    usage:
+        stream = JSONStream(fp)
+        for key in stream.members():
+            value = stream.value()      # or iterate stream.members() of the value
+    """
+
+    def __init__(self, fp, chunk_size=1 << 16):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size):
+        """
+        read more data, returns False at the end of the file
+        """
+        if self.eof:
+            return False
+        chunk = self.fp.read(size)
+        self.eof = not chunk
+        self.buffer = self.buffer[self.pos :] + self.utf8.decode(chunk, self.eof)
+        self.pos = 0
+        return not self.eof
+
+    def _peek(self):
+        """
+        skip the whitespaces and returns the next character
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill(self.chunk_size):
+                raise json.JSONDecodeError("Unexpected end", self.buffer, self.pos)
+
+    def _expect(self, chars):
+        c = self._peek()
+        if c not in chars:
+            raise json.JSONDecodeError(f"Expecting {chars!r}", self.buffer, self.pos)
+        self.pos += 1
+        return c
+
+    def value(self):
+        """
+        decode the next value
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number may continue in the next chunk (1. 1e 1e-): it ends with
+                # a delimiter
+                if (
+                    self.eof
+                    or not isinstance(value, (int, float))
+                    or (end < len(self.buffer) and self.buffer[end] in " \t\r\n,]}")
+                ):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # read at least as much as the buffered value: linear time for long values
+            self._fill(max(self.chunk_size, len(self.buffer) - self.pos))
+
+    def members(self):
+        """
+        yields the keys of the next object, the caller has to read each value
+        """
+        self._expect("{")
+        if self._peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self._expect(":")
+            yield key
+            if self._expect(",}") == "}":
+                return
+
+
+def read_metadata(data):
+    """
+    returns the info, the last_serial and an iterator of the releases (version, files)
+    of the JSON metadata, as bytes or as a binary file parsed incrementally
+    """
+
+    if isinstance(data, bytes):
+        metadata = json.loads(data)
+        return (
+            metadata["info"],
+            metadata["last_serial"],
+            iter(metadata["releases"].items()),
+        )
+
+    stream = JSONStream(data)
+    members = stream.members()
+    header = dict()
+    for key in members:
+        if key == "releases" and "info" in header and "last_serial" in header:
+            break
+        header[key] = stream.value()
+    else:
+        # releases before info: already decoded
+        return header["info"], header["last_serial"], iter(header["releases"].items())
+
+    def releases():
+        for release in stream.members():
+            yield release, stream.value()
+        # check the end of the document
+        for _ in members:
+            stream.value()
+
+    return header["info"], header["last_serial"], releases()
+
+
+def store_metadata(db, name, last_serial, fp, codec=None):
+    """
+    store the raw JSON metadata from a binary file into meta_db.package
+    by incremental blob I/O, compressed by codec if any
+    """
+
+    fp.seek(0)
+    if codec is not None:
+        compressed = tempfile.TemporaryFile()
+        codec.compress_file(fp, compressed)
+        fp = compressed
+    size = fp.seek(0, os.SEEK_END)
+    fp.seek(0)
+
+    if not hasattr(db, "blobopen"):
+        # Python < 3.11
+        db.execute(
+            "insert or replace into meta_db.package (name,last_serial,metadata) values (?,?,?)",
+            (name, last_serial, fp.read()),
+        )
+        return
+
+    cur = db.execute(
+        "insert or replace into meta_db.package (name,last_serial,metadata) values (?,?,zeroblob(?))",
+        (name, last_serial, size),
+    )
+    with db.blobopen("package", "metadata", cur.lastrowid, name="meta_db") as blob:
+        shutil.copyfileobj(fp, blob, 1 << 16)
+
+
+def add_package(db, orig_name, data, use_meta_db, bulk=None, codec=None):
+    """
+    add or update a package from the JSON metadata
+
+    data is the JSON document, as bytes or as a binary file (see read_metadata):
+    a file is parsed incrementally and its rows are written by batches
+
+    only the differences with the stored package are written,
+    by bulk or immediately if bulk is None or data is a file
+
+    the raw JSON is compressed by codec, if any
+
+    returns the count of the changes (releases and files added, removed, updated)
+    """
+
+    info, last_serial, releases = read_metadata(data)
+    name = info["name"]
+
+    if name != orig_name:
+        logger.error(f"{name} != {orig_name}")
+        assert name == orig_name
+
+    # ajoute le last_serial (plutôt que dans une table séparée)
+    info["last_serial"] = last_serial
+
+    if bulk is not None and bulk.pending(name):
+        # the stored package has to be up to date
+        bulk.apply()
+
+    stored = stored_package(db, name)
+    if stored is None:
+        stored = set(), None, set(), dict()
+    stored_classifiers, stored_requires_dist, stored_releases, stored_files = stored
+
+    streamed = not isinstance(data, bytes)
+    if bulk is None or streamed:
+        writer = BulkWriter(db)
+        db.execute("savepoint add_package")
+    else:
+        writer = None
+
+    def write(rows):
+        if writer is None:
+            bulk.add(name, rows)
+        else:
+            writer.add(name, rows)
+            for _, e in writer.flush():
+                raise e
+
+    try:
+        changes = defaultdict(int)
+        rows = defaultdict(list)
+
+        # the package
+        rows["package"].append(tuple(info.get(i) for i in PACKAGE_COLUMNS))
+
+        # classifiers
+        classifiers = set(info["classifiers"])
+        for classifier in classifiers - stored_classifiers:
+            rows["classifier"].append((classifier,))
+            rows["package_classifier"].append((name, classifier))
+        for classifier in stored_classifiers - classifiers:
+            rows["delete_package_classifier"].append((name, classifier))
+
+        # requirements
+        requires_dist = info["requires_dist"] or []
+        if requires_dist != stored_requires_dist:
+            if stored_requires_dist:
+                rows["delete_requires_dist"].append((name,))
+            rows["requires_dist"] = [
+                (dist, *parse_requirement(dist), name) for dist in requires_dist
+            ]
+
+        listed_releases = set()
+        for release, files in releases:
+            listed_releases.add(release)
+
+            # release
+            if release not in stored_releases:
+                rows["release"].append((release, version_key(release), name))
+                changes["releases_added"] += 1
+
+            # distribution files
+            for file in files:
+                # we need only the SHA256 digest
+                file["sha256_digest"] = file["digests"]["sha256"]
+
+                row = file_row(file)
+                stored_file = stored_files.pop(file["url"], None)
+                if stored_file is None:
+                    rows["file"].append(row + (name, release))
+                    changes["files_added"] += 1
+                elif stored_file != (row, release):
+                    rows["update_file"].append(row + (name, release, file["url"]))
+                    changes["files_updated"] += 1
+
+            if streamed and len(rows["file"]) + len(rows["update_file"]) >= 10000:
+                write(rows)
+                rows = defaultdict(list)
+
+        # releases and files no longer listed
+        for release in stored_releases - listed_releases:
+            rows["delete_release"].append((name, release))
+            changes["releases_removed"] += 1
+        for url in stored_files.keys():
+            rows["delete_file"].append((url,))
+            changes["files_removed"] += 1
+
+        # the raw JSON
+        if use_meta_db and not streamed:
+            if codec is not None:
+                data = codec.compress(data)
+            rows["meta_db.package"].append((name, last_serial, data))
+
+        write(rows)
+
+        if use_meta_db and streamed:
+            store_metadata(db, name, last_serial, data, codec)
+
+    except BaseException:
+        if writer is not None:
+            db.execute("rollback to add_package")
+            db.execute("release add_package")
+        raise
+
+    if writer is not None:
+        db.execute("release add_package")
+
+    logger.debug(f"package added: {name} {last_serial} {dict(changes)}")
+
+    return changes
+
+
+class AdaptiveConcurrency:
+    """
+    limit the number of requests in flight, AIMD style:
+        - halve the limit when the server answers 429 or 5xx
+        - increase it by one after a window of requests with a flat latency
+    """
+
+    def __init__(self, maximum):
+        self.maximum = max(1, maximum)
+        self.limit = min(4, self.maximum)
+        self.in_flight = 0
+        self.successes = 0
+        self.baseline = None
+        self.cond = threading.Condition()
+
+    def __enter__(self):
+        with self.cond:
+            while self.in_flight >= self.limit:
+                self.cond.wait()
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, type, value, traceback):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify()
+
+    def feedback(self, status_code, latency):
+        """
+        adjust the limit according to the response of the server
+        """
+        with self.cond:
+            if status_code == 429 or status_code >= 500:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+                logger.debug(f"HTTP {status_code}: concurrency down to {self.limit}")
+                return
+
+            # baseline latency: slowly drifting minimum
+            if self.baseline is None or latency < self.baseline:
+                self.baseline = latency
+            else:
+                self.baseline += (latency - self.baseline) * 0.01
+
+            if latency > self.baseline * 1.5:
+                self.successes = 0
+                return
+
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self.successes = 0
+                self.cond.notify()
+                logger.debug(f"concurrency up to {self.limit}")
+
+
+class TransientError(Exception):
+    """
+    a failure that should not last: network error, timeout, stall, server overloaded
+    """
+
+
+def iter_content(response, chunk_size=1 << 16, decode_content=True):
+    """
+    iterate over the body of a streamed response
+
+    with decode_content=False, the body is returned as sent (Content-Encoding ignored)
+
+    raises TransientError if the throughput falls below MIN_THROUGHPUT
+    """
+
+    def read1():
+        # the data available, not a full chunk: the stalls are seen in time
+        while True:
+            chunk = response.raw.read1(chunk_size, decode_content=decode_content)
+            if not chunk:
+                return
+            yield chunk
+
+    if hasattr(response.raw, "read1"):
+        # urllib3 2
+        chunks = read1()
+    elif decode_content:
+        chunks = response.iter_content(chunk_size)
+    else:
+        chunks = response.raw.stream(chunk_size, decode_content=False)
+
+    start = time.monotonic()
+    received = 0
+    for chunk in chunks:
+        yield chunk
+        received += len(chunk)
+        elapsed = time.monotonic() - start
+        if elapsed >= STALL_PERIOD:
+            if received < MIN_THROUGHPUT * elapsed:
+                raise TransientError(
+                    f"transfer stalled: {received} bytes in {elapsed:.0f}s"
+                )
+            start += elapsed
+            received = 0
+
+
+def retry_after(response):
+    """
+    the delay in seconds requested by the Retry-After header, or None
+    """
+
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+        return max(0.0, date.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def http_get(session, url, read, retries=6, limiter=None, ctrl_c=None, **kwargs):
+    """
+    GET an URL and returns read(response), the body has to be read with iter_content()
+
+    the transient failures (network errors, timeouts, stalls, 429 and 5xx responses)
+    are retried after an exponential backoff with jitter, or the Retry-After delay
+
+    raises:
+        FileNotFoundError       404
+        requests.HTTPError      other client errors: permanent
+        TransientError          the retries are exhausted
+    """
+
+    for attempt in range(retries):
+        delay = None
+        try:
+            with limiter or contextlib.nullcontext():
+                start = time.monotonic()
+                with session.get(
+                    url, stream=True, timeout=HTTP_TIMEOUT, **kwargs
+                ) as response:
+                    if limiter is not None:
+                        limiter.feedback(response.status_code, time.monotonic() - start)
+                    if response.ok:
+                        return read(response)
+
+            if response.status_code == 404:
+                raise FileNotFoundError(url)
+            if response.status_code != 429 and response.status_code < 500:
+                response.raise_for_status()
+
+            error = TransientError(f"HTTP {response.status_code}")
+            delay = retry_after(response)
+
+        except (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+            urllib3.exceptions.HTTPError,
+            TransientError,
+        ) as e:
+            error = e
+
+        if attempt + 1 == retries or ctrl_c:
+            break
+
+        if delay is None:
+            delay = BACKOFF_BASE * 2**attempt
+            delay = random.uniform(delay / 2, delay)
+        delay = min(delay, BACKOFF_MAX)
+        logger.debug(f"{url}: {error!r}, retry in {delay:.1f}s")
+
+        deadline = time.monotonic() + delay
+        while not ctrl_c and time.monotonic() < deadline:
+            time.sleep(min(0.5, deadline - time.monotonic()))
+
+    if isinstance(error, TransientError):
+        raise error
+    raise TransientError(repr(error)) from error
+
+
+def read_document(response, max_size=LARGE_DOCUMENT):
+    """
+    returns the body of a response as bytes, or as a temporary file beyond max_size
+    """
+
+    chunks = []
+    size = 0
+    fp = None
+    for chunk in iter_content(response):
+        if fp is not None:
+            fp.write(chunk)
+            continue
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > max_size:
+            fp = tempfile.TemporaryFile()
+            fp.writelines(chunks)
+            chunks = None
+
+    if fp is None:
+        return b"".join(chunks)
+    fp.seek(0)
+    return fp
+
+
+def fetch_metadata(names, pypi_uri, jobs, ctrl_c, retries=6):
+    """
+    download the JSON metadata of the projects with a pool of threads
+
+    yields (name, data, error) in the same order as names
+    data is bytes, or a temporary file for the large documents (see read_document)
+    """
+
+    limiter = AdaptiveConcurrency(jobs)
+    local = threading.local()
+    sessions = []
+
+    def fetch(name):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+            sessions.append(session)
+
+        # 404: weird... package is listed in list_packages but not accessible
+        # from pypi.org, it occurs probably when the package has no release
+        return http_get(
+            session,
+            f"{pypi_uri}/{name}/json",
+            read_document,
+            retries,
+            limiter,
+            ctrl_c,
+            headers={"Content-Type": "application/json"},
+        )
+
+    # keep a bounded window of requests ahead of the writer
+    window = jobs * 4
+    pending = deque()
+    names = iter(names)
+    executor = ThreadPoolExecutor(max_workers=jobs)
+
+    try:
+        while True:
+            while not ctrl_c and len(pending) < window:
+                name = next(names, None)
+                if name is None:
+                    break
+                pending.append((name, executor.submit(fetch, name)))
+
+            if not pending:
+                break
+
+            name, future = pending.popleft()
+            try:
+                yield name, future.result(), None
+            except Exception as e:
+                yield name, None, e
+
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        for session in sessions:
+            session.close()
+
+
+def refill_list(client, db, db_serial, clear_ignore=False):
+    """
+    replace the list of packages with the full response of list_packages_with_serial
+    """
+
+    # ----- list_packages_with_serial -----
+    packages = client.list_packages_with_serial()
+    logger.info("packages listed: %d", len(packages))
+
+    ignore_flags = defaultdict(lambda: False)
+    if not clear_ignore:
+        # fetch the ignore flags
+        # for packages not modified since the last update
+        for row in db.execute(
+            "select name,ignore from list_packages where last_serial<=?",
+            (db_serial,),
+        ):
+            ignore_flags[row[0]] = row[1]
+
+    # replace the list of packages with the fresh one, ignore flag preserved
+    logger.info("refill table list_packages")
+    db.execute("delete from list_packages")
+    db.executemany(
+        "insert into list_packages (name,last_serial,ignore) values (?,?,?)",
+        [
+            (name, last_serial, ignore_flags[name])
+            for name, last_serial in packages.items()
+        ],
+    )
+
+    if clear_ignore:
+        # the ignored packages are behind the checkpoint of download_metadata
+        db.execute("delete from sync_state where key='metadata_checkpoint'")
+
+    db.execute(
+        "insert or replace into sync_state (key,value) values ('full_refresh',?)",
+        (int(time.time()),),
+    )
+
+
+def apply_changelog(client, db, db_serial, last_serial):
+    """
+    update the list of packages with the events since db_serial
+    """
+
+    updated = dict()
+    removed = set()
+
+    # ----- changelog_since_serial -----
+    # list of (name, version, timestamp, action, serial)
+    # the server returns a limited number of events per call
+    serial = db_serial
+    events = 0
+    while serial < last_serial:
+        changelog = client.changelog_since_serial(serial)
+        if not changelog or max(change[4] for change in changelog) <= serial:
+            break
+        events += len(changelog)
+
+        for name, version, timestamp, action, serial in sorted(
+            changelog, key=lambda change: change[4]
+        ):
+            if action == "remove project":
+                removed.add(name)
+                updated.pop(name, None)
+            else:
+                if action.startswith("rename from "):
+                    old_name = action[len("rename from ") :]
+                    removed.add(old_name)
+                    updated.pop(old_name, None)
+                removed.discard(name)
+                updated[name] = max(serial, updated.get(name, 0))
+
+    logger.info(f"changelog events: {events}")
+
+    for name in removed:
+        logger.debug(f"removed: {name}")
+    db.executemany("delete from list_packages where name=?", ((i,) for i in removed))
+
+    # modified packages lose their ignore flag, like with a full refresh
+    db.executemany(
+        """\
+insert into list_packages (name,last_serial,ignore) values (?,?,0)
+on conflict (name) do update set last_serial=excluded.last_serial,ignore=0
+where excluded.last_serial>last_serial
+""",
+        updated.items(),
+    )
+
+
+def update_list(client, db, clear_ignore=False, full_refresh=False):
+    """
+    download and update the list of packages with their last_serial
+
+    the list is updated with the changelog since the db serial, and fully
+    refreshed if asked or when the last full refresh is too old
+    """
+
+    db_serial = fetch_value(db, "select last_serial from pypi_last_serial")
+    logger.info(f"db serial: {db_serial}")
+
+    # ----- changelog_last_serial -----
+    last_serial_time = int(time.time())
+    last_serial = client.changelog_last_serial()
+    logger.info(f"server serial: {last_serial}")
+
+    if last_serial == db_serial:
+        logger.info("database is up to date")
+    else:
+        # the server serial is different from ours: we have to update
+
+        logger.info(f"update events: {last_serial - db_serial}")
+        db.execute("delete from pypi_last_serial")
+        db.execute(
+            "insert into pypi_last_serial (last_serial, timestamp) values (?,?)",
+            (last_serial, last_serial_time),
+        )
+
+        full_refresh_time = fetch_value(
+            db, "select value from sync_state where key='full_refresh'"
+        )
+        if (
+            full_refresh
+            or clear_ignore
+            or db_serial == 0
+            or last_serial_time - full_refresh_time > FULL_REFRESH_PERIOD
+        ):
+            refill_list(client, db, db_serial, clear_ignore)
+        else:
+            logger.info("apply changelog to table list_packages")
+            apply_changelog(client, db, db_serial, last_serial)
+
+        # print the list of updated packages
+        for row in db.execute(
+            "select name from list_packages where last_serial>?", (db_serial,)
+        ):
+            name = row[0]
+            logger.debug(f"updated: {name}")
+
+        updated = fetch_value(
+            db, "select count(*) from list_packages where last_serial>?", db_serial
+        )
+        logger.info(f"updated: {updated}")
+
+    # print some stats
+    total = fetch_value(db, "select count(*) from list_packages")
+    logger.info(f"packages: {total}")
+
+    ignored = fetch_value(db, "select count(*) from list_packages where ignore=1")
+    logger.info(f"ignored: {ignored}")
+
+    db.commit()
+
+
+def download_metadata(
+    db,
+    use_meta_db,
+    pypi_uri,
+    whitelist_cond=None,
+    jobs=1,
+    commit_count=1000,
+    commit_interval=60,
+):
+    """
+    download and parse JSON metadata
+
+    only needed (missing and updated) packages will be downloaded
+    the downloads run in `jobs` threads, the database is written by the caller thread
+
+    the work is committed every `commit_count` packages or `commit_interval` seconds,
+    with a checkpoint: an interrupted run restarts after the last committed package
+
+    the raw JSON metadata is stored into a separated database, attached to db
+    the metadata is parsed and stored into tables of db
+    """
+
+    codec = None
+    if use_meta_db:
+        db.execute("attach database ? as meta_db", (get_meta_db_path(db),))
+
+        codec = MetadataCodec(db)
+        if not codec.dictionary_id:
+            samples = codec.sample()
+            if len(samples) >= 1000:
+                codec.train(samples)
+                db.commit()
+
+    # update metadata only from whitelist
+    if whitelist_cond:
+        whitelist = set()
+        canonicalize_named_names = dict(
+            (canonicalize_name(name), name)
+            for name, in db.execute("select name from list_packages")
+        )
+        for cond in whitelist_cond:
+            m = re.match(r"^([^=<>~]+)(.*)?$", cond)
             name = canonicalize_name(m.group(1))
             if name in canonicalize_named_names:
                 name = canonicalize_named_names[name]
@@ -531,9 +1870,6 @@ def download_metadata(db, use_meta_db, pypi_uri, whitelist_cond=None):
     else:
         whitelist = None
 
-    # requests session to download the JSON metadata
-    session = requests.Session()
-
     # remove packages that are no longer listed
     sql = """\
 select name from package where name not in (select name from list_packages)
@@ -543,199 +1879,1323 @@ select name from package where name not in (select name from list_packages)
         delete_package(db, name, use_meta_db)
     db.commit()
 
+    # the packages are processed by increasing last_serial: the last_serial of the
+    # last committed package is a checkpoint if the run is interrupted
+    # (not used with a whitelist, since the other packages are skipped)
+    if whitelist:
+        resume_serial = 0
+    else:
+        resume_serial = fetch_value(
+            db, "select value from sync_state where key='metadata_checkpoint'"
+        )
+        if resume_serial:
+            logger.info(f"resume after serial {resume_serial}")
+
     with CtrlC() as ctrl_c:
 
         # fetch the list of packages that are:
         #  - not ignored
         #  - modified (different last_serial) or missing
+        #  - not processed by an interrupted run
         sql = """\
 select lp.name,lp.last_serial,p.last_serial
 from list_packages as lp
 left join package as p on lp.name=p.name
 where lp.ignore=0
   and (p.last_serial<lp.last_serial or p.name is null)
+  and lp.last_serial>?
 order by lp.last_serial
 """
-        rows = db.execute(sql).fetchall()
+        rows = db.execute(sql, (resume_serial,)).fetchall()
         logger.info(f"metadata to download: {len(rows)}")
 
-        processed = 0
+        processed = 0
+        retry_later = 0
+        start_time = time.monotonic()
+        commit_time = start_time
+        commit_processed = 0
+        position = resume_serial
+
+        bulk = BulkWriter(db)
+        changes = defaultdict(int)
+
+        def flush():
+            for name, e in bulk.flush():
+                logger.error(f"error {name} : {e!r}")
+                db.execute("update list_packages set ignore=1 where name=?", (name,))
+
+        def commit():
+            nonlocal commit_time, commit_processed
+            flush()
+            if not whitelist:
+                db.execute(
+                    "insert or replace into sync_state (key,value) values ('metadata_checkpoint',?)",
+                    (position,),
+                )
+            db.commit()
+            checkpoint(db)
+            commit_time = time.monotonic()
+            commit_processed = processed
+
+        serials = dict((row[0], (row[1], row[2])) for row in rows)
+        names = [name for name in serials.keys() if not whitelist or name in whitelist]
+
+        fetcher = fetch_metadata(names, pypi_uri, jobs, ctrl_c)
+        for name, data, error in fetcher:
+
+            if ctrl_c:
+                break
+
+            last_serial, db_serial = serials[name]
+            logger.info(f"bump package {name} from serial {db_serial} to {last_serial}")
+
+            try:
+                if error:
+                    raise error
+
+                # parse and store the metadata
+                for change, count in add_package(
+                    db, name, data, use_meta_db, bulk, codec
+                ).items():
+                    changes[change] += count
+
+            except TransientError as e:
+                # not ignored: the package is still outdated and will be retried
+                logger.warning(f"error {name} : {e}")
+                retry_later += 1
+
+            except (
+                sqlite3.IntegrityError,
+                sqlite3.InterfaceError,
+                json.decoder.JSONDecodeError,
+                Exception,
+            ) as e:
+                logger.error(f"error {name} : {e!r}")
+                db.execute("update list_packages set ignore=1 where name=?", (name,))
+
+            finally:
+                if hasattr(data, "close"):
+                    # temporary file of a large document
+                    data.close()
+
+            processed += 1
+            if not retry_later:
+                # the checkpoint must not skip a package to retry
+                position = last_serial
+
+            if (
+                processed - commit_processed >= commit_count
+                or time.monotonic() - commit_time >= commit_interval
+            ):
+                commit()
+                logger.debug(f"resume position: {position}")
+            elif bulk.full():
+                bulk.apply()
+
+        # wait for the requests in flight
+        fetcher.close()
+
+        if not ctrl_c:
+            # the run is complete
+            position = 0
+        commit()
+
+        elapsed = time.monotonic() - start_time
+        logger.info(f"packages processed: {processed}")
+        if elapsed > 0:
+            logger.info(f"throughput: {processed / elapsed:.1f} packages/s")
+        for change in sorted(changes.keys()):
+            logger.info(f"{change.replace('_', ' ')}: {changes[change]}")
+        if retry_later:
+            logger.warning(f"packages to retry (transient errors): {retry_later}")
+        if len(rows) != processed:
+            logger.warning(f"packages remaining: {len(rows) - processed}")
+
+        if ctrl_c:
+            logger.warning("terminated")
+            exit(0)
+
+    # sanitize metadata database...
+    if use_meta_db:
+        db.execute(
+            "delete from meta_db.package where name not in (select name from package)"
+        )
+        db.commit()
+        db.execute("detach database meta_db")
+
+
+def recompress_metadata(db, batch_size=1000):
+    """
+    train a new dictionary and compress again all the raw JSON metadata
+    """
+
+    db.execute("attach database ? as meta_db", (get_meta_db_path(db),))
+
+    codec = MetadataCodec(db)
+    codec.train(codec.sample())
+    db.commit()
+
+    names = [name for name, in db.execute("select name from meta_db.package")]
+    logger.info(f"documents to compress: {len(names)}")
+
+    before = 0
+    after = 0
+    with CtrlC() as ctrl_c:
+        for i in range(0, len(names), batch_size):
+            if ctrl_c:
+                break
+
+            rows = []
+            for name in names[i : i + batch_size]:
+                (blob,) = db.execute(
+                    "select metadata from meta_db.package where name=?", (name,)
+                ).fetchone()
+                compressed = codec.compress(codec.decompress(blob))
+                before += len(blob)
+                after += len(compressed)
+                rows.append((compressed, name))
+
+            db.executemany("update meta_db.package set metadata=? where name=?", rows)
+            db.commit()
+            checkpoint(db)
+            logger.info(f"compressed: {min(i + batch_size, len(names))}/{len(names)}")
+
+    if before:
+        logger.info(
+            f"metadata size: {hf.format_size(before)} -> {hf.format_size(after)} "
+            f"({after / before * 100:.1f}%)"
+        )
+
+    # remove the unused dictionaries
+    used = set(
+        codec.HEADER.unpack_from(blob, 1)[0]
+        for blob, in db.execute("select substr(metadata,1,5) from meta_db.package")
+        if blob and blob[:1] == codec.MAGIC
+    )
+    db.executemany(
+        "delete from meta_db.dictionary where id=?",
+        (
+            (i,)
+            for i, in db.execute("select id from meta_db.dictionary").fetchall()
+            if i not in used
+        ),
+    )
+    db.commit()
+    db.execute("detach database meta_db")
+    logger.info("run VACUUM on the metadata database to reclaim the space")
+
+
+def build_index(name, last_serial, releases, web_root, local_files=None):
+    """
+    create the index.html page for the given name/releases/last_serial
+
+    releases are ordered by version (see version_key)
+    local_files are the paths of the files of the mirror, the disk is checked if None
+    """
+
+    index_html = list()
+
+    for r, files in releases.items():
+        for f in files:
+            path = urlparse(f["url"]).path[1:]
+
+            # if file is present, we add it to the index regardless of the filters
+            if local_files is not None:
+                if path not in local_files:
+                    continue
+            elif not (web_root / path).is_file():
+                continue
+
+            if f["requires_python"]:
+                req = escape(f["requires_python"])
+                index_html.append(
+                    f"""\
+<a href="../../{path}#sha256={f['digests']['sha256']}" data-requires-python="{req}">{f['filename']}</a><br/>
+"""
+                )
+            else:
+                index_html.append(
+                    f"""\
+<a href="../../{path}#sha256={f['digests']['sha256']}">{f['filename']}</a><br/>
+"""
+                )
+    index_html = (
+        f"""\
+<!DOCTYPE html>
+<html>
+  <head>
+    <title>Links for {name}</title>
+  </head>
+  <body>
+    <h1>Links for {name}</h1>
+"""
+        + "".join(index_html)
+        + f"""\
+  </body>
+</html>
+<!--SERIAL {last_serial}-->\
+"""
+    )
+
+    return index_html
+
+
+# version of build_index, to change when the content of the pages changes
+INDEX_VERSION = 1
+
+
+def index_digest(present):
+    """
+    digest of the local files listed in the index of a package
+    """
+    h = hashlib.sha1(f"{INDEX_VERSION}\n".encode())
+    for path in sorted(present):
+        h.update(path.encode() + b"\n")
+    return h.hexdigest()
+
+
+def write_index(web_root, name, simple_index):
+    """
+    write the index.html page of a package, atomically for the clients of the mirror
+    """
+    p = web_root / "simple" / canonicalize_name(name) / "index.html"
+    p.parent.mkdir(exist_ok=True, parents=True)
+    tmp = p.with_name(f".index.html.{os.getpid()}")
+    try:
+        with tmp.open("w") as fp:
+            fp.write(simple_index)
+        os.replace(tmp, p)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def write_package_index(web_root, name, last_serial, releases, present):
+    """
+    build and write the index.html page of a package (run by the reindex workers)
+    """
+    write_index(
+        web_root, name, build_index(name, last_serial, releases, web_root, present)
+    )
+    return name
+
+
+def reindex_packages(db, web_root, dry_run=False, jobs=1):
+    """
+    write again the index.html pages of the packages whose last_serial or local files
+    changed since their page was written, with a pool of `jobs` processes
+    """
+
+    indexed = dict(
+        (name, (last_serial, digest))
+        for name, last_serial, digest in db.execute(
+            "select name,last_serial,digest from simple_index"
+        )
+    )
+
+    written = 0
+    skipped = 0
+    pending = dict()
+
+    def collect(futures):
+        for future in futures:
+            name, last_serial, digest = pending.pop(future)
+            future.result()
+            db.execute(
+                "insert or replace into simple_index (name,last_serial,digest) values (?,?,?)",
+                (name, last_serial, digest),
+            )
+
+    with ProcessPoolExecutor(jobs) as pool:
+        for name, last_serial, version, files in package_files(db):
+
+            present = set(local_files(db, [url_path(row[2]) for row in files]))
+            if not present and name not in indexed:
+                # never mirrored
+                continue
+
+            digest = index_digest(present)
+            if indexed.get(name) == (last_serial, digest):
+                p = web_root / "simple" / canonicalize_name(name) / "index.html"
+                if p.is_file():
+                    skipped += 1
+                    continue
+
+            written += 1
+            logger.debug(f"reindex {name}")
+            if dry_run:
+                continue
+
+            # only the files of the mirror are listed
+            releases = defaultdict(list)
+            for row in files:
+                if url_path(row[2]) in present:
+                    releases[row[0]].append(
+                        {
+                            "filename": row[1],
+                            "url": row[2],
+                            "requires_python": row[4],
+                            "digests": {"sha256": row[5]},
+                        }
+                    )
+
+            future = pool.submit(
+                write_package_index, web_root, name, last_serial, releases, present
+            )
+            pending[future] = (name, last_serial, digest)
+            if len(pending) >= jobs * 16:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+
+        collect(list(pending))
+
+    db.commit()
+
+    logger.info(f"index pages written: {written} skipped: {skipped}")
+
+
+class TargetEnvironments:
+    """
+    the environments of the clients of the mirror: Linux, CPython, the given python
+    versions and machines
+
+    a requirement applies if its marker is true in one of the environments, the
+    result is cached by marker
+    """
+
+    def __init__(self, pythons=TARGET_PYTHONS, machines=TARGET_MACHINES):
+        self.pythons = tuple(sorted(set(pythons), key=version_key))
+        self.machines = tuple(sorted(set(machines)))
+        self.environments = [
+            {
+                "implementation_name": "cpython",
+                "implementation_version": f"{python}.0",
+                "os_name": "posix",
+                "platform_machine": machine,
+                "platform_python_implementation": "CPython",
+                "platform_release": "",
+                "platform_system": "Linux",
+                "platform_version": "",
+                "python_full_version": f"{python}.0",
+                "python_version": python,
+                "sys_platform": "linux",
+            }
+            for python in self.pythons
+            for machine in self.machines
+        ]
+        self.cache = dict()
+
+    def __repr__(self):
+        return f"linux {','.join(self.machines)} CPython {','.join(self.pythons)}"
+
+    def config(self):
+        """
+        the configuration, part of the fingerprint of the filters
+        """
+        return {"pythons": list(self.pythons), "machines": list(self.machines)}
+
+    def applies(self, marker, extra=""):
+        """
+        True if the marker is true in one of the environments (or invalid), with
+        the given extra
+        """
+
+        if marker is None:
+            return True
+
+        key = (marker, extra)
+        result = self.cache.get(key)
+        if result is None:
+            try:
+                m = Marker(marker)
+                result = any(
+                    m.evaluate(dict(environment, extra=extra))
+                    for environment in self.environments
+                )
+            except (UndefinedComparison, UndefinedEnvironmentName, InvalidVersion):
+                result = True
+            self.cache[key] = result
+        return result
+
+
+class DependencyGraph:
+    """
+    graph of the dependencies between the packages, built once from requires_dist
+
+    the nodes are integer ids: the packages, then the dependencies missing from the
+    catalog (by canonical name); the edges are stored in arrays, with the reverse
+    edges grouped by dependency: the dependants of the node i are
+    dependants[offsets[i]:offsets[i + 1]]
+    """
+
+    # the requirements of the graph: invalid ones and extra features are ignored
+    # https://setuptools.readthedocs.io/en/latest/setuptools.html#declaring-extras-optional-features-with-their-own-dependencies
+    SQL = """\
+select package_id,name,specifier,marker from requires_dist
+where error=0 and extra is null"""
+
+    def __init__(self, db, environments=None):
+        """
+        the requirements whose marker does not apply to the environments are pruned
+        """
+
+        self.names = []
+        self.ids = dict()
+        self.canonical = canonical = dict()  # canonical name -> node
+        nodes = dict()  # package.id -> node
+        for package_id, name in db.execute("select id,name from package"):
+            nodes[package_id] = len(self.names)
+            self.ids[name] = canonical[canonicalize_name(name)] = len(self.names)
+            self.names.append(name)
+
+        # the edges: dependant, dependency, specifier (index in self.specifiers or -1)
+        self.sources = array("i")
+        self.targets = array("i")
+        self.specifier_ids = array("i")
+        self.specifiers = []
+        specifier_ids = dict()
+
+        pruned = 0
+        for package_id, dist, specifier, marker in db.execute(self.SQL):
+            source = nodes.get(package_id)
+            if source is None:
+                # orphan row
+                continue
+            if environments is not None and not environments.applies(marker):
+                pruned += 1
+                continue
+            target = canonical.get(dist)
+            if target is None:
+                target = canonical[dist] = self.ids[dist] = len(self.names)
+                self.names.append(dist)
+            if specifier is None:
+                k = -1
+            else:
+                k = specifier_ids.get(specifier)
+                if k is None:
+                    k = specifier_ids[specifier] = len(self.specifiers)
+                    self.specifiers.append(specifier)
+            self.sources.append(source)
+            self.targets.append(target)
+            self.specifier_ids.append(k)
+
+        # reverse edges, sorted by dependency (counting sort)
+        self.offsets = array("i", bytes(4 * (len(self.names) + 1)))
+        for target in self.targets:
+            self.offsets[target + 1] += 1
+        for i in range(len(self.names)):
+            self.offsets[i + 1] += self.offsets[i]
+        position = array("i", self.offsets)
+        self.dependants = array("i", bytes(4 * len(self.targets)))
+        for source, target in zip(self.sources, self.targets):
+            self.dependants[position[target]] = source
+            position[target] += 1
+
+        self.excluded = bytearray(len(self.names))
+        self.reasons = dict()
+
+        logger.info(
+            f"dependency graph: {len(self.names)} nodes, {len(self.targets)} edges"
+            f" ({pruned} requirements for other environments)"
+        )
+
+    def node(self, name):
+        """
+        the node of a package or a dependency, by name or canonical name
+        """
+        i = self.ids.get(name)
+        if i is None:
+            i = self.canonical.get(canonicalize_name(name))
+        return i
+
+    def exclude(self, names):
+        """
+        exclude the packages and all their dependants, by a breadth-first search on
+        the reverse edges, and returns the names of the excluded dependants
+        """
+
+        queue = deque()
+        for name in names:
+            i = self.node(name)
+            if i is not None and not self.excluded[i]:
+                self.excluded[i] = 1
+                queue.append(i)
+
+        added = []
+        while queue:
+            i = queue.popleft()
+            for j in self.dependants[self.offsets[i] : self.offsets[i + 1]]:
+                if not self.excluded[j]:
+                    self.excluded[j] = 1
+                    self.reasons[j] = i
+                    added.append(j)
+                    queue.append(j)
+
+        return [self.names[i] for i in added]
+
+    def why(self, name):
+        """
+        the path from an excluded package to the excluded package it depends on:
+        [name, dependency, ..., cause], [name] if excluded by itself, None if not
+        """
+
+        i = self.node(name)
+        if i is None or not self.excluded[i]:
+            return None
+        path = [name]
+        while i in self.reasons:
+            i = self.reasons[i]
+            path.append(self.names[i])
+        return path
+
+    def specifier_counts(self):
+        """
+        the count of the dependants not excluded by specifier of the dependencies:
+        canonical name -> specifier -> count
+        """
+
+        keys = dict((i, name) for name, i in self.canonical.items())
+        counts = dict()
+        for source, target, k in zip(self.sources, self.targets, self.specifier_ids):
+            if k != -1 and not self.excluded[source]:
+                specifiers = counts.setdefault(keys[target], dict())
+                specifier = self.specifiers[k]
+                specifiers[specifier] = specifiers.get(specifier, 0) + 1
+        return counts
+
+
+def explain_exclusion(graph, name):
+    """
+    the reason why a package is excluded, as a text
+    """
+
+    path = graph.why(name)
+    if path is None:
+        return f"{name} is not excluded"
+    if len(path) == 1:
+        return f"{name} is blacklisted"
+    if len(path) == 2:
+        return f"{name} excluded because of {path[-1]}"
+    return f"{name} excluded because of {path[-1]} via {' -> '.join(path[1:-1])}"
+
+
+def whitelist_closure(db, whitelist_cond, environments=None):
+    """
+    the transitive closure of the whitelist requirements (name[extras]specifier) over
+    the requirements of the catalog: name -> set of specifiers
+
+    the dependencies of a package are those of its current version, with the extras
+    requested by its dependants; the packages without metadata are included, but
+    not their dependencies; the requirements whose marker does not apply to the
+    environments are pruned
+    """
+
+    canonicalize_named_names = dict(
+        (canonicalize_name(name), name)
+        for name, in db.execute(
+            "select name from list_packages union select name from package"
+        )
+    )
+
+    sql = """\
+select r.requires_dist,r.name,r.specifier,r.marker,r.extra
+from requires_dist as r join package as p on p.id=r.package_id
+where p.name=? and r.error=0"""
+
+    conditions = defaultdict(set)
+    visited = set()
+    queue = deque()
+
+    def require(name, specifier, extras):
+        name = canonicalize_named_names.get(name)
+        if name is None:
+            return False
+        conditions[name]
+        if specifier:
+            conditions[name].add(specifier)
+        for extra in (None, *extras):
+            if (name, extra) not in visited:
+                visited.add((name, extra))
+                queue.append((name, extra))
+        return True
+
+    for cond in whitelist_cond:
+        cond = cond.split("#")[0].strip()
+        if not cond:
+            continue
+        try:
+            req = Requirement(cond)
+        except InvalidRequirement:
+            logger.warning(f"invalid whitelist requirement: {cond}")
+            continue
+        if req.marker and environments is not None:
+            if not environments.applies(str(req.marker)):
+                continue
+        extras = [canonicalize_name(i) for i in req.extras]
+        if not require(canonicalize_name(req.name), str(req.specifier), extras):
+            logger.warning(f"unknown whitelist package: {req.name}")
+
+    while queue:
+        name, extra = queue.popleft()
+        for dist, dep, specifier, marker, dep_extra in db.execute(sql, (name,)):
+            if dep_extra is not None:
+                # dependency of an extra feature
+                if extra is None or extra not in dep_extra.split(","):
+                    continue
+            elif extra is not None:
+                # already followed for the package without extra
+                continue
+            if environments is not None:
+                if not environments.applies(marker, extra or ""):
+                    continue
+            extras = []
+            if "[" in dist:
+                extras = [canonicalize_name(i) for i in Requirement(dist).extras]
+            require(dep, specifier, extras)
+
+    logger.info(
+        f"whitelist closure: {len(conditions)} packages from {len(whitelist_cond)} requirements"
+    )
+
+    return conditions
+
+
+def compute_requirements(db, blacklist=set(), environments=None):
+    """
+    analyse les requirements pour ne pas exclure des packages indispensables
+
+    les packages qui dépendent d'un package blacklisté sont ajoutés à la blacklist
+    les requirements qui ne s'appliquent pas aux environments sont ignorés
+
+    retourne les raisons des ajouts à la blacklist (nom -> nom de la dépendance
+    blacklistée) et les conditions (voir DependencyGraph.specifier_counts)
+    """
+
+    graph = DependencyGraph(db, environments)
+
+    added = graph.exclude(blacklist)
+    if logger.isEnabledFor(logging.DEBUG):
+        for name in added:
+            logger.debug(explain_exclusion(graph, name))
+    blacklist.update(added)
+    logger.info(f"packages added to the blacklist: {len(added)}")
+
+    reasons = dict(
+        (name, graph.names[graph.reasons[graph.ids[name]]]) for name in added
+    )
+
+    return reasons, graph.specifier_counts()
+
+
+# above this count of packages to evaluate again, update_requirements gives up
+UPDATE_REQUIREMENTS_LIMIT = 100000
 
-        for row in rows:
 
-            if ctrl_c:
+def update_requirements(db, state, blacklist, environments, names):
+    """
+    update the results of compute_requirements for the changes of the initial
+    blacklist and of the catalog since they were computed, logged by triggers into
+    package_change and requirement_change
+
+    state["reasons"] is excluded name -> excluded dependency (None for the
+    blacklist), state["counts"] the counts of specifier_counts, names the names of
+    the packages by canonical name
+
+    returns the count of changes, None if a full computation is faster
+    """
+
+    reasons = state["reasons"]
+    counts = state["counts"]
+
+    changed = set(name for name, in db.execute("select name from package_change"))
+    changed.update(blacklist ^ state["blacklist"])
+
+    # the changed requirements with a specifier (see DependencyGraph.SQL)
+    log = defaultdict(int)
+    for package, dist, specifier, marker, delta in db.execute(
+        "select package,name,specifier,marker,delta from requirement_change"
+    ):
+        log[package, dist, specifier, marker] += delta
+    log = dict((k, delta) for k, delta in log.items() if delta != 0)
+
+    if not changed and not log:
+        return 0
+
+    forward = """\
+select r.name,r.specifier,r.marker
+from requires_dist as r join package as p on p.id=r.package_id
+where p.name=? and r.error=0 and r.extra is null"""
+    reverse = """\
+select p.name,r.marker
+from requires_dist as r join package as p on p.id=r.package_id
+where r.name=? and r.error=0 and r.extra is null"""
+
+    before = set(reasons)
+    excluded = set(canonicalize_name(name) for name in reasons)
+
+    # the exclusions that depend on a changed package are evaluated again
+    children = defaultdict(list)
+    for name, reason in reasons.items():
+        if reason is not None:
+            children[canonicalize_name(reason)].append(name)
+    queue = deque(name for name in changed if name in reasons)
+    again = set(changed)
+    while queue:
+        name = queue.popleft()
+        if name in reasons:
+            del reasons[name]
+            excluded.discard(canonicalize_name(name))
+            again.add(name)
+            queue.extend(children.get(canonicalize_name(name), ()))
+
+    if len(again) > UPDATE_REQUIREMENTS_LIMIT:
+        return None
+
+    def exclude(name, reason):
+        reasons[name] = reason
+        excluded.add(canonicalize_name(name))
+        queue = deque([name])
+        while queue:
+            dist = canonicalize_name(queue.popleft())
+            for dependant, marker in db.execute(reverse, (dist,)).fetchall():
+                if dependant not in reasons and environments.applies(marker):
+                    reasons[dependant] = names.get(dist, dist)
+                    excluded.add(canonicalize_name(dependant))
+                    queue.append(dependant)
+
+    for name in sorted(again):
+        if name in reasons:
+            continue
+        if name in blacklist:
+            exclude(name, None)
+            continue
+        for dist, _, marker in db.execute(forward, (name,)).fetchall():
+            if dist in excluded and environments.applies(marker):
+                exclude(name, names.get(dist, dist))
                 break
 
-            name = row[0]
+    after = set(reasons)
 
-            if whitelist and name not in whitelist:
-                continue
+    def count(dist, specifier, delta):
+        specifiers = counts.setdefault(dist, dict())
+        n = specifiers.get(specifier, 0) + delta
+        if n:
+            specifiers[specifier] = n
+        else:
+            del specifiers[specifier]
+            if not specifiers:
+                del counts[dist]
+
+    # the removed requirements were counted with the previous exclusions, the added
+    # ones are counted with the current exclusions
+    added = defaultdict(lambda: defaultdict(int))
+    for (package, dist, specifier, marker), delta in log.items():
+        if delta > 0:
+            added[package][dist, specifier, marker] += delta
+        if environments.applies(marker):
+            if package not in (before if delta < 0 else after):
+                count(dist, specifier, delta)
+
+    # the other requirements of the packages whose exclusion changed
+    for package in before ^ after:
+        delta = 1 if package in before else -1
+        rows = defaultdict(int)
+        for row in db.execute(forward, (package,)):
+            if row[1] is not None:
+                rows[row] += 1
+        for (dist, specifier, marker), n in rows.items():
+            n -= added[package].get((dist, specifier, marker), 0)
+            if n > 0 and environments.applies(marker):
+                count(dist, specifier, delta * n)
+
+    state["blacklist"] = blacklist
+    return len(again) + len(log)
+
+
+# version of the derived data of get_requirements, to change when they change
+DERIVED_VERSION = 1
+
+
+def get_requirements(db, environments):
+    """
+    the blacklist, with the dependants of the blacklisted packages, and the
+    requirement conditions: name -> set of specifiers
 
-            logger.info(f"bump package {name} from serial {row[2]} to {row[1]}")
+    they are computed from data stored in the derived_data table, with the serial of
+    the catalog and a fingerprint of the configuration, and updated for the changes
+    of the catalog only
+    """
 
-            try:
-                url = f"{pypi_uri}/{name}/json"
-                req = session.get(url, headers={"Content-Type": "application/json"})
-                if req.status_code == 404:
-                    # weird... package is listed in list_packages
-                    # but not accessible from pypi.org
-                    # it occurs probably when the package has no release
-                    raise FileNotFoundError
+    blacklist, _ = get_blacklist(db)
 
-                data = req.content
+    names = dict(
+        (canonicalize_name(name), name)
+        for name, in db.execute("select name from package")
+    )
+    serial = fetch_value(db, "select max(last_serial) from package") or 0
+    fingerprint = hashlib.sha1(
+        json.dumps([DERIVED_VERSION, environments.config()]).encode()
+    ).hexdigest()[:16]
+
+    row = db.execute(
+        "select serial,fingerprint,data from derived_data where key='requirements'"
+    ).fetchone()
+
+    changes = None
+    if row is not None and row[1] == fingerprint:
+        state = pickle.loads(row[2])
+        changes = update_requirements(db, state, blacklist, environments, names)
+        if changes is not None:
+            logger.info(
+                f"requirements updated from serial {row[0]} to {serial}: {changes} changes"
+            )
 
-                # parse and store the metadata
-                add_package(db, name, data, use_meta_db)
+    if changes is None:
+        reasons = dict((name, None) for name in blacklist)
+        added, counts = compute_requirements(db, set(blacklist), environments)
+        reasons.update(added)
+        state = {"blacklist": blacklist, "reasons": reasons, "counts": counts}
 
-            except (
-                sqlite3.IntegrityError,
-                sqlite3.InterfaceError,
-                json.decoder.JSONDecodeError,
-                Exception,
-            ) as e:
-                logger.error(f"error {name} : {e!r}")
-                db.execute("update list_packages set ignore=1 where name=?", (name,))
+    if changes != 0:
+        db.execute(
+            "insert or replace into derived_data (key,serial,fingerprint,data) values ('requirements',?,?,?)",
+            (serial, fingerprint, pickle.dumps(state, pickle.HIGHEST_PROTOCOL)),
+        )
+    db.execute("delete from package_change")
+    db.execute("delete from requirement_change")
+    db.commit()
 
-            processed += 1
+    # the conditions on the packages not excluded
+    excluded = set(canonicalize_name(name) for name in state["reasons"])
+    conditions = defaultdict(set)
+    for dist, specifiers in state["counts"].items():
+        if dist not in excluded:
+            conditions[names.get(dist, dist)] = set(specifiers)
+    logger.info(f"packages with requirement conditions: {len(conditions)}")
 
-        db.commit()
+    return set(state["reasons"]), conditions
 
-        logger.info(f"packages processed: {processed}")
-        if len(rows) != processed:
-            logger.warning(f"packages remaining: {len(rows) - processed}")
 
-        if ctrl_c:
-            logger.warning("terminated")
-            exit(0)
+def discard_requirements(db):
+    """
+    forget the data of get_requirements and the changes logged since, when they are
+    not used
+    """
+    db.execute("delete from derived_data where key='requirements'")
+    db.execute("delete from package_change")
+    db.execute("delete from requirement_change")
+    db.commit()
 
-    session.close()
 
-    # sanitize metadata database...
-    if use_meta_db:
+def url_path(url):
+    """
+    the path of a file in the mirror, relative to the web root
+    """
+    return urlparse(url).path[1:]
+
+
+def local_files(db, paths):
+    """
+    returns the dict path -> size of the paths found in the local_file inventory
+    """
+    return dict(
         db.execute(
-            "delete from meta_db.package where name not in (select name from package)"
+            "select path,size from local_file where path in (select value from json_each(?))",
+            (json.dumps(paths),),
         )
-        db.commit()
-        db.execute("detach database meta_db")
+    )
 
 
-def build_index(name, last_serial, releases, web_root):
+def record_local_file(db, web_root, path, sha256=None, dry_run=False):
     """
-    create the index.html page for the given name/releases/last_serial
+    add a file of the mirror to the local_file inventory
+
+    returns its size, or None if the file does not exist
     """
+    try:
+        st = (web_root / path).stat()
+    except FileNotFoundError:
+        return None
+    if not dry_run:
+        db.execute(
+            "insert or replace into local_file (path,size,sha256,mtime) values (?,?,?,?)",
+            (path, st.st_size, sha256, st.st_mtime),
+        )
+    return st.st_size
 
-    index_html = list()
 
-    versions = sorted(map(lambda v: (parse(v), v), releases.keys()))
+def rescan_local_files(db, web_root, jobs=8):
+    """
+    reconcile the local_file inventory with the files of the mirror
 
-    for _, r in versions:
-        for f in releases[r]:
-            path = urlparse(f["url"]).path[1:]
+    the directories of packages/ are scanned by `jobs` threads and compared one by one
+    with the inventory: a file with another size or mtime loses its verified digest
 
-            # if file is present, we add it to the index regardless of the filters
-            p = web_root / path
-            if not p.is_file():
-                continue
+    the .part files of the interrupted downloads are recorded too, for remove_orphans
+    """
 
-            if f["requires_python"]:
-                req = escape(f["requires_python"])
-                index_html.append(
-                    f"""\
-<a href="../../{path}#sha256={f['digests']['sha256']}" data-requires-python="{req}">{f['filename']}</a><br/>
-"""
+    root = web_root / "packages"
+    skip = len(os.fspath(root)) + 1
+
+    def scan(directory):
+        found = dict()
+        stack = [directory]
+        while stack:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        st = entry.stat()
+                        path = "packages/" + entry.path[skip:].replace(os.sep, "/")
+                        found[path] = (st.st_size, st.st_mtime)
+        return directory, found
+
+    directories = []
+    if root.is_dir():
+        directories = sorted(i.path for i in os.scandir(root) if i.is_dir())
+    logger.info(f"scanning {len(directories)} directories of {root}")
+
+    counts = defaultdict(int)
+    prefixes = []
+    with ThreadPoolExecutor(jobs) as executor:
+        for directory, found in executor.map(scan, directories):
+            # range of the paths of the directory: "packages/ab/" to "packages/ab0"
+            prefix = "packages/" + directory[skip:].replace(os.sep, "/") + "/"
+            prefixes.append(prefix)
+
+            stored = dict(
+                (path, (size, mtime))
+                for path, size, mtime in db.execute(
+                    "select path,size,mtime from local_file where path>=? and path<?",
+                    (prefix, prefix[:-1] + "0"),
                 )
-            else:
-                index_html.append(
-                    f"""\
-<a href="../../{path}#sha256={f['digests']['sha256']}">{f['filename']}</a><br/>
-"""
+            )
+            for path in stored.keys() - found.keys():
+                db.execute("delete from local_file where path=?", (path,))
+                counts["removed"] += 1
+            for path, (size, mtime) in found.items():
+                if path not in stored:
+                    counts["added"] += 1
+                elif stored[path] != (size, mtime):
+                    counts["changed"] += 1
+                else:
+                    continue
+                db.execute(
+                    "insert or replace into local_file (path,size,sha256,mtime) values (?,?,null,?)",
+                    (path, size, mtime),
                 )
-    index_html = (
-        f"""\
-<!DOCTYPE html>
-<html>
-  <head>
-    <title>Links for {name}</title>
-  </head>
-  <body>
-    <h1>Links for {name}</h1>
-"""
-        + "".join(index_html)
-        + f"""\
-  </body>
-</html>
-<!--SERIAL {last_serial}-->\
-"""
+            counts["files"] += len(found)
+
+    # the paths outside of the scanned directories
+    bounds = [""] + [i for p in sorted(prefixes) for i in (p, p[:-1] + "0")] + [None]
+    for low, high in zip(bounds[::2], bounds[1::2]):
+        if high is None:
+            cur = db.execute("delete from local_file where path>=?", (low,))
+        else:
+            cur = db.execute(
+                "delete from local_file where path>=? and path<?", (low, high)
+            )
+        counts["removed"] += cur.rowcount
+
+    if counts["added"] or counts["changed"] or counts["removed"]:
+        # the indexes and the files of the packages have to be checked again
+        db.execute("delete from mirrored_package")
+        logger.info("the next mirroring will process all the packages")
+
+    db.execute(
+        "insert or replace into sync_state (key,value) values ('local_file_scan',?)",
+        (int(time.time()),),
     )
+    db.commit()
 
-    return index_html
+    for count in ("files", "added", "changed", "removed"):
+        logger.info(f"local files {count}: {counts[count]}")
 
 
-def compute_requirements(db, blacklist=set()):
+def get_progress(db):
     """
-    analyse les requirements pour ne pas exclure des packages indispensables
+    names of the packages processed by the current mirroring pass
     """
+    return set(row[0] for row in db.execute("select name from progress"))
 
-    conditions = defaultdict(set)
-    for iteration in range(1, 10):
-        added = 0
-        name_cond_pattern = re.compile(r"^(.+?)(?:\s\((.+)\))?$")
-        for name, dist in db.execute("select name, requires_dist from requires_dist"):
 
-            # ne pas considérer des dépendances de paquets qu'on ne veut pas
-            if name in blacklist:
-                continue
+def reset_progress(db, names=None):
+    """
+    start a new mirroring pass, or process again some packages of the current one
 
-            m = dist.split(";", maxsplit=2)
-            if len(m) > 1:
-                # ignore les requirements qui déclarent une extra feature dependency
-                # https://setuptools.readthedocs.io/en/latest/setuptools.html#declaring-extras-optional-features-with-their-own-dependencies
-                extra = m[1].replace(" ", "")
-                if extra.find("extra==") != -1:
-                    continue
+    the given packages are processed again even if unchanged, with their index page
+    """
+    if names is None:
+        db.execute("delete from progress")
+    else:
+        for table in ("progress", "mirrored_package", "simple_index"):
+            db.executemany(f"delete from {table} where name=?", ((i,) for i in names))
+    db.commit()
+
+
+def import_progress(db, web_root):
+    """
+    import the progress file of the previous versions
+    """
+    z = web_root / "done"
+    if z.exists():
+        with z.open() as fp:
+            db.executemany(
+                "insert or ignore into progress (name) values (?)",
+                ((i.strip(),) for i in fp if i.strip()),
+            )
+        db.commit()
+        z.unlink()
 
-            m = name_cond_pattern.match(m[0].strip())
 
-            dist = m.group(1)
-            cond = m.group(2)
+# version of the filters, to change when their behaviour changes
+FILTER_VERSION = 2
+
+
+def filter_fingerprint(config, conditions):
+    """
+    fingerprint of the filters of a package: their configuration and the conditions
+    on the releases of the package
+    """
+    data = json.dumps([FILTER_VERSION, config, sorted(conditions or ())])
+    return hashlib.sha1(data.encode()).hexdigest()[:16]
+
+
+def package_files(db, names=None, skip=()):
+    """
+    yields (name, last_serial, version, files) of the packages, or only of names
+
+    files is the list of (release, filename, url, size, requires_python, sha256_digest,
+    python_version) ordered by version, empty for the packages in skip
+
+    without names, the packages and the files are read by two scans in the same order,
+    merged here: no query by package, no sort, and the files of the skipped packages
+    are not read out of SQLite
+    """
+
+    columns = """\
+r.release,f.filename,f.url,f.size,f.requires_python,f.sha256_digest,f.python_version"""
+
+    if names is not None:
+        sql = f"""\
+select {columns}
+from release as r join file as f on f.release_id=r.id
+where r.package_id=?
+order by r.sort_key,r.id,f.id
+"""
+        for name in names:
+            row = db.execute(
+                "select id,last_serial,version from package where name=?", (name,)
+            ).fetchone()
+            if row is not None:
+                yield name, row[1], row[2], db.execute(sql, (row[0],)).fetchall()
+        return
+
+    db.execute("create temp table if not exists skip_package (name text primary key)")
+    db.execute("delete from temp.skip_package")
+    db.executemany(
+        "insert or ignore into temp.skip_package (name) values (?)",
+        ((name,) for name in skip),
+    )
+    db.commit()
+
+    files = db.execute(
+        f"""\
+select r.package_id,{columns}
+from release as r join file as f on f.release_id=r.id
+where r.package_id not in
+    (select p.id from temp.skip_package as s join package as p on p.name=s.name)
+order by r.package_id,r.sort_key,r.id,f.id
+"""
+    )
+    row = next(files, None)
+
+    for package_id, name, last_serial, version in db.execute(
+        "select id,name,last_serial,version from package order by id"
+    ):
+        rows = []
+        while row is not None and row[0] == package_id:
+            rows.append(row[1:])
+            row = next(files, None)
+        yield name, last_serial, version, rows
 
-            # on ignore les requirements d'extra feature
-            if dist.find("[") != -1:
-                continue
 
-            if dist in blacklist:
-                # la dépendance de name est blacklistée, on blackliste name aussi
-                logger.debug(f"{name} blacklisted because of {dist}")
-                blacklist.add(name)
-                added += 1
-                if name in conditions:
-                    del conditions[name]
+class Downloader:
+    """
+    download files with a pool of threads sharing a pool of connections
+
+    the files in flight (queued or downloading) are limited in count and total size,
+    a file larger than max_bytes is downloaded alone
+
+    usage:
+        downloader = Downloader(jobs, ctrl_c)
+        <loop>
+            downloader.submit(key, url, filename, size, sha256)
+            for key, error in downloader.results():
+                <handle the result>
+        downloader.close()
+        for key, error in downloader.results():
+            <handle the result>
+    """
+
+    def __init__(self, jobs, ctrl_c=None, max_bytes=DOWNLOAD_MAX_BYTES):
+        self.ctrl_c = ctrl_c
+        self.max_files = jobs * 4
+        self.max_bytes = max_bytes
+        self.adapter = requests.adapters.HTTPAdapter(pool_maxsize=jobs)
+        self.local = threading.local()
+        self.sessions = []
+        self.executor = ThreadPoolExecutor(jobs, thread_name_prefix="download")
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        self.in_flight_bytes = 0
+        self.done = deque()
+        self.transfers = dict()
+        self.received = 0
+        self.start_time = time.monotonic()
+        self.progress_time = self.start_time
+
+    def _session(self):
+        # one session by thread, all using the same connections
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+            session.mount("https://", self.adapter)
+            session.mount("http://", self.adapter)
+            self.sessions.append(session)
+        return session
+
+    def _download(self, key, url, filename, size, sha256):
+        transfer = [filename.name, 0, size]
+        self.transfers[threading.current_thread().name] = transfer
+
+        # the file is written aside, renamed when complete and verified
+        # a partial download is kept and resumed with a Range request
+        part = filename.with_name(filename.name + ".part")
+        headers = dict()
+
+        def resume():
+            offset = part.stat().st_size if part.exists() else 0
+            if 0 < offset < size:
+                headers["Range"] = f"bytes={offset}-"
             else:
-                if cond:
-                    conditions[dist].add(cond)
+                headers.pop("Range", None)
+
+        def save(response):
+            digest = hashlib.sha256()
+            offset = 0
+            if response.status_code == 206:
+                m = re.match(r"bytes (\d+)-", response.headers.get("Content-Range", ""))
+                offset = int(m.group(1)) if m else -1
+                if offset != part.stat().st_size:
+                    part.unlink()
+                    raise TransientError(f"unexpected range: {m and m.group(0)}")
+                with part.open("rb") as fp:
+                    while True:
+                        chunk = fp.read(1 << 20)
+                        if not chunk:
+                            break
+                        digest.update(chunk)
+                logger.debug(f"{url}: resume at {offset}")
+
+            transfer[1] = offset
+            with part.open("ab" if offset else "wb") as fp:
+                for chunk in iter_content(response, decode_content=False):
+                    fp.write(chunk)
+                    digest.update(chunk)
+                    transfer[1] += len(chunk)
+                    with self.cond:
+                        self.received += len(chunk)
+
+            if transfer[1] != size:
+                error = f"size mismatch: {transfer[1]} bytes instead of {size}"
+            elif sha256 and digest.hexdigest() != sha256:
+                error = f"sha256 mismatch: {digest.hexdigest()} instead of {sha256}"
+            else:
+                os.replace(part, filename)
+                return
+            logger.warning(f"{url}: {error}")
+            part.unlink()
+            raise TransientError(error)
 
-        if added:
-            logger.info(
-                f"iteration {iteration}: packages added to the blacklist: {added}"
-            )
-        else:
-            break
+        def read(response):
+            try:
+                save(response)
+            finally:
+                # the next attempt continues the part
+                resume()
 
-    # f = pathlib.Path("conditions.log")
-    # f.open("w").write("".join(sorted(f"{i:30} {j}\n" for i, j in conditions.items())))
-    logger.info(f"packages with requirement conditions: {len(conditions)}")
+        error = None
+        try:
+            resume()
+            http_get(self._session(), url, read, ctrl_c=self.ctrl_c, headers=headers)
+        except Exception as e:
+            error = e
+            if not isinstance(e, TransientError):
+                part.unlink(missing_ok=True)
+        finally:
+            del self.transfers[threading.current_thread().name]
+            with self.cond:
+                self.in_flight -= 1
+                self.in_flight_bytes -= size
+                self.done.append((key, error))
+                self.cond.notify_all()
+
+    def submit(self, key, url, filename, size, sha256=None):
+        """
+        download url into filename, waits for room if needed
 
-    return conditions
+        the file is written only if its size and SHA-256 digest are the expected ones
+        """
+        with self.cond:
+            while self.in_flight and (
+                self.in_flight >= self.max_files
+                or self.in_flight_bytes + size > self.max_bytes
+            ):
+                self.cond.wait(1)
+                self.progress()
+            self.in_flight += 1
+            self.in_flight_bytes += size
+        self.executor.submit(self._download, key, url, filename, size, sha256)
+        self.progress()
+
+    def results(self):
+        """
+        returns the list of (key, error) of the finished downloads, error is None on success
+        """
+        with self.cond:
+            done = list(self.done)
+            self.done.clear()
+        return done
 
+    def progress(self, force=False):
+        """
+        log the progress of the downloads, every PROGRESS_PERIOD seconds
+        """
+        now = time.monotonic()
+        if not force and now - self.progress_time < PROGRESS_PERIOD:
+            return
+        self.progress_time = now
+        rate = self.received / max(now - self.start_time, 1e-3)
+        logger.info(
+            f"downloads: {self.in_flight} files in flight"
+            f" ({hf.format_size(self.in_flight_bytes)}),"
+            f" {hf.format_size(self.received)} received at {hf.format_size(rate)}/s"
+        )
+        for worker, (filename, received, size) in sorted(self.transfers.items()):
+            logger.debug(f"{worker}: {filename} {received}/{size}")
 
-def get_cached_list(filename, getter):
-    f = pathlib.Path(filename + ".cache")
-    if f.is_file():
-        resource = pickle.load(f.open("rb"))
-    else:
-        resource = getter()
-        pickle.dump(resource, f.open("wb"), pickle.HIGHEST_PROTOCOL)
-    return resource
+    def close(self, cancel=False):
+        """
+        wait for the downloads in progress, the queued ones are cancelled if cancel
+        """
+        if cancel:
+            logger.info(f"waiting for {len(self.transfers)} downloads in progress")
+        self.executor.shutdown(wait=True, cancel_futures=cancel)
+        for session in self.sessions:
+            session.close()
+        self.adapter.close()
 
 
 def download_packages(
@@ -748,23 +3208,42 @@ def download_packages(
     keep_releases=3,
     remove_filtered_releases=False,
     save_progress=True,
+    jobs=1,
+    incremental=True,
+    environments=None,
 ):
+    """
+    download the files of the packages selected by the filters and build the indexes
+
+    the files are downloaded by `jobs` threads (see Downloader), the index of a package
+    is written when all its files are downloaded
+
+    if incremental, the packages are skipped if neither their last_serial nor their
+    filters changed since they were mirrored
+
+    the requirements are evaluated for the target environments (see
+    TargetEnvironments)
+    """
+
+    if environments is None:
+        environments = TargetEnvironments()
+    logger.info(f"target environments: {environments}")
 
     if only_whitelist:
-        # download only the listed packages
+        # download only the listed packages and their dependencies
         blacklist = set()
-        conditions = defaultdict(list)
+        conditions = whitelist_closure(db, whitelist_cond or (), environments)
+        discard_requirements(db)
     else:
         # the blacklist and calculated requirement conditions
-        blacklist, _ = get_cached_list("blacklist", lambda: get_blacklist(db))
-        conditions = get_cached_list(
-            "conditions", lambda: compute_requirements(db, blacklist)
-        )
+        blacklist, conditions = get_requirements(db, environments)
 
     # the whitelist
-    if (isinstance(whitelist_cond, tuple) or isinstance(whitelist_cond, list)) and len(
-        whitelist_cond
-    ) != 0:
+    if (
+        not only_whitelist
+        and (isinstance(whitelist_cond, tuple) or isinstance(whitelist_cond, list))
+        and len(whitelist_cond) != 0
+    ):
         whitelist = defaultdict(set)
         canonicalize_named_names = dict(
             (canonicalize_name(name), name)
@@ -784,43 +3263,164 @@ def download_packages(
                 logger.info(f"unblacklisting {name}")
                 blacklist.remove(name)
 
+    if not fetch_value(db, "select value from sync_state where key='local_file_scan'"):
+        # first use of the inventory of the local files
+        rescan_local_files(db, web_root, jobs)
+
+    # configuration of the filters, part of the fingerprint of the mirrored packages
+    filter_config = {
+        "latest_release": {"keep": keep_releases, "only_required": only_whitelist},
+        "blacklist": {"platforms": "windows macos freebsd"},
+        "index": not no_index,
+        "environments": environments.config(),
+    }
+
     # initialize plugins borrowed and adapted from bandersnatch
     filter_releases = latest_name.LatestReleaseFilter()
-    filter_releases.configuration = {"latest_release": {"keep": keep_releases}}
+    filter_releases.configuration = {"latest_release": filter_config["latest_release"]}
     filter_releases.initialize_plugin()
 
     filter_platform = filename_name.ExcludePlatformFilter()
-    filter_platform.configuration = {
-        "blacklist": {"platforms": "windows macos freebsd"}
-    }
+    filter_platform.configuration = {"blacklist": filter_config["blacklist"]}
     filter_platform.initialize_plugin()
 
+    # the packages mirrored with the same serial and filters
+    unchanged = set()
+    if incremental and not remove_filtered_releases:
+        sql = """\
+select m.name,m.fingerprint
+from mirrored_package as m
+join package as p on p.name=m.name and p.last_serial=m.last_serial
+"""
+        for name, fingerprint in db.execute(sql):
+            if fingerprint == filter_fingerprint(filter_config, conditions.get(name)):
+                unchanged.add(name)
+        logger.info(f"packages unchanged since their last mirroring: {len(unchanged)}")
+
     exist = 0
     download = 0
     download_size = 0
     processed = 0
+    failed = 0
 
     removed_files = 0
     removed_size = 0
 
+    import_progress(db, web_root)
     if save_progress:
-        # add the "done" list to the blacklist (faster)
-        z = web_root / "done"
-        if z.exists():
-            for i in z.open():
-                blacklist.add(i.strip())
+        # add the packages already processed to the blacklist (faster)
+        done = get_progress(db)
+        if done:
+            logger.info(f"packages already processed by this pass: {len(done)}")
+            blacklist.update(done)
+
+    # packages waiting for their downloads:
+    #   name -> [files to download, last_serial, unfiltered releases, complete,
+    #            local files]
+    waiting = dict()
+    commit_time = time.monotonic()
+
+    def finish(name, last_serial, unfiltered_releases, complete, present):
+        """
+        write the index of a package and save the progress
+        """
+        nonlocal processed, commit_time
+
+        if not no_index:
+            # build the index.html file, unless its serial and files are unchanged
+            digest = index_digest(present)
+            p = web_root / "simple" / canonicalize_name(name) / "index.html"
+            row = db.execute(
+                "select last_serial,digest from simple_index where name=?", (name,)
+            ).fetchone()
+            if row != (last_serial, digest) or not p.is_file():
+                simple_index = build_index(
+                    name, last_serial, unfiltered_releases, web_root, present
+                )
+
+                if not dry_run:
+                    write_index(web_root, name, simple_index)
+                    db.execute(
+                        "insert or replace into simple_index (name,last_serial,digest) values (?,?,?)",
+                        (name, last_serial, digest),
+                    )
 
-    session = requests.Session()
+        processed += 1
+
+        # save progress, the packages with failed downloads will be retried
+        if save_progress and complete:
+            db.execute("insert or ignore into progress (name) values (?)", (name,))
+
+        if complete and not dry_run and not remove_filtered_releases:
+            db.execute(
+                "insert or replace into mirrored_package (name,last_serial,fingerprint) values (?,?,?)",
+                (
+                    name,
+                    last_serial,
+                    filter_fingerprint(filter_config, conditions.get(name)),
+                ),
+            )
+
+        # the progress and the local_file inventory
+        if time.monotonic() - commit_time >= 60:
+            db.commit()
+            commit_time = time.monotonic()
+
+    def collect():
+        """
+        handle the finished downloads
+        """
+        nonlocal failed
+
+        for (name, url, sha256), error in downloader.results():
+            state = waiting[name]
+            path = url_path(url)
+            if error is None:
+                state[4][path] = record_local_file(db, web_root, path, sha256)
+                db.execute("delete from local_file where path=?", (path + ".part",))
+            else:
+                # the part kept to resume the download, for remove_orphans
+                if record_local_file(db, web_root, path + ".part") is None:
+                    db.execute("delete from local_file where path=?", (path + ".part",))
+                if not isinstance(
+                    error, (FileNotFoundError, requests.HTTPError, TransientError)
+                ):
+                    raise error
+                logger.error(f"download {url} failed: {error!r}")
+                failed += 1
+                state[3] = False
+            state[0] -= 1
+            if state[0] == 0:
+                del waiting[name]
+                finish(name, *state[1:])
 
     with CtrlC(True) as ctrl_c:
 
+        downloader = Downloader(jobs, ctrl_c)
+
         try:
-            count = fetch_value(db, "select count(*) from package")
+            if only_whitelist:
+                # only a few packages: one query by package
+                packages = package_files(db, sorted(conditions.keys()))
+                count = len(conditions)
+            else:
+                packages = package_files(db, skip=blacklist | unchanged)
+                count = fetch_value(db, "select count(*) from package")
             progress = 0
 
-            for name, last_serial, version in db.execute(
-                "select name,last_serial,version from package"
-            ):
+            def lookup(present, path):
+                """
+                size of a file of the mirror, None if missing
+                """
+                if path not in present:
+                    # not in the inventory: stored by a previous version?
+                    size = record_local_file(db, web_root, path, dry_run=dry_run)
+                    if size is None:
+                        return None
+                    present[path] = size
+                return present[path]
+
+            for name, last_serial, version, files in packages:
 
                 progress += 1
                 if progress % 5000 == 0:
@@ -835,6 +3435,9 @@ def download_packages(
                 elif name in blacklist:
                     continue
 
+                if name in unchanged:
+                    continue
+
                 logger.debug(f"process {name}")
 
                 # rebuild the JSON metadata (only needed fields)
@@ -845,8 +3448,7 @@ def download_packages(
                 #   releases = data['releases']
                 info = {"name": name, "version": version}
                 releases = defaultdict(list)
-                sql = "select release,filename,url,size,requires_python,sha256_digest,python_version from file where name=?"  # noqa
-                for row in db.execute(sql, (name,)):
+                for row in files:
                     releases[row[0]].append(
                         {
                             "filename": row[1],
@@ -861,21 +3463,39 @@ def download_packages(
                 unfiltered_releases = releases.copy()
                 removed_desc = []
 
+                # the files of the package in the mirror: path -> size
+                present = local_files(
+                    db,
+                    [url_path(f["url"]) for r in releases.values() for f in r],
+                )
+
                 filter_releases.filter(
                     info, releases, conditions.get(name, None), removed_desc
                 )
                 filter_platform.filter(info, releases, removed_desc)
 
+                # registered before its first download, that may be collected while
+                # the next ones are submitted (Ctrl-C): one count is held until all
+                # its files are submitted
+                state = [1, last_serial, unfiltered_releases, True, present]
+                waiting[name] = state
+
                 if remove_filtered_releases:
                     # clean unwanted releases (too old, by platform)
                     for desc in removed_desc:
-                        filename = web_root / urlparse(desc["url"]).path[1:]
+                        path = url_path(desc["url"])
+                        filename = web_root / path
 
-                        if filename.exists():
+                        size = lookup(present, path)
+                        if size is not None:
                             removed_files += 1
-                            removed_size += filename.stat().st_size
+                            removed_size += size
                             if not dry_run:
-                                filename.unlink()
+                                filename.unlink(missing_ok=True)
+                                db.execute(
+                                    "delete from local_file where path=?", (path,)
+                                )
+                                del present[path]
                                 try:
                                     filename.parent.rmdir()
                                 except OSError:
@@ -888,12 +3508,10 @@ def download_packages(
                     for r in releases.values():
                         for f in r:
                             url = f["url"]
-                            path = urlparse(url).path[1:]
+                            path = url_path(url)
 
                             filename = web_root / path
-                            if filename.exists() and filename.stat().st_size == int(
-                                f["size"]
-                            ):
+                            if lookup(present, path) == int(f["size"]):
                                 exist += 1
                             else:
                                 download += 1
@@ -909,39 +3527,43 @@ def download_packages(
                                         filename.parent.unlink()
                                     filename.parent.mkdir(exist_ok=True, parents=True)
 
-                                    with session.get(url, stream=True) as r:
-                                        with filename.open("wb") as f:
-                                            shutil.copyfileobj(r.raw, f)
-
-                if not no_index:
-                    # build the index.html file
-                    simple_index = build_index(
-                        name, last_serial, unfiltered_releases, web_root
-                    )
+                                    downloader.submit(
+                                        (name, url, f["digests"]["sha256"]),
+                                        url,
+                                        filename,
+                                        int(f["size"]),
+                                        f["digests"]["sha256"],
+                                    )
+                                    state[0] += 1
 
-                    if not dry_run:
-                        p = web_root / "simple" / canonicalize_name(name) / "index.html"
-                        p.parent.mkdir(exist_ok=True, parents=True)
-                        with p.open("w") as fp:
-                            fp.write(simple_index)
+                # finished now, or when the downloads are done
+                state[0] -= 1
+                if state[0] == 0:
+                    del waiting[name]
+                    finish(name, *state[1:])
 
-                processed += 1
+                collect()
 
-                # save progress
-                if save_progress:
-                    with open(web_root / "done", "a") as fp:
-                        print(name, file=fp)
+            downloader.close()
 
         except KeyboardInterrupt:
             logger.warning("interrupt")
+            downloader.close(cancel=True)
 
         except Exception as e:
             logger.error(f"{e!r}")
+            downloader.close(cancel=True)
             raise e
 
+        # the packages with all their files downloaded
+        collect()
+        db.commit()
+
         logger.info(
             f"processed={processed} exist={exist} download={download} download_size={hf.format_size(download_size)} ({download_size} bytes)"
         )  # noqa
+        if failed:
+            logger.warning(f"downloads failed: {failed}")
 
         if remove_filtered_releases:
             logger.info(f"files removed: {removed_files}")
@@ -954,36 +3576,38 @@ def download_packages(
             exit(0)
 
 
-def remove_orphans(db, web_root, dry_run):
+def remove_orphans(db, web_root, dry_run, jobs=8):
     """
-    find and delete files that are no longer listed in any release of any project
+    find and delete files that are no longer listed in any release of any project,
+    and the parts of their interrupted downloads
     """
 
-    p = web_root
-    lp = len(p.as_posix())
+    if not fetch_value(db, "select value from sync_state where key='local_file_scan'"):
+        # first use of the inventory of the local files
+        rescan_local_files(db, web_root, jobs)
 
-    logger.info(f"looking for orphan files in {p}")
+    logger.info(f"looking for orphan files in {web_root}")
 
     removed_files = 0
     removed_size = 0
-    p /= "packages"
-    for f in p.glob("**/*"):
-        if f.is_file():
-            url = "https://files.pythonhosted.org" + f.as_posix()[lp:]
-            # nota: indexing by url is important here...
-            n = fetch_value(db, "select count(*) from file where url=?", (url,))
-            if n == 0:
-                removed_files += 1
-                removed_size += f.stat().st_size
-                if not dry_run:
-                    f.unlink()
-                # problem: globbing fails is we remove the current directory
-                # try:
-                #     f.parent.rmdir()
-                # except OSError:
-                #     # not empty, should not occur
-                #     pass
-                logger.debug(f"unlink orphan {f}")
+
+    # nota: indexing by url is important here...
+    sql = """\
+select path,size from local_file as l
+where not exists (
+    select 1 from file
+    where url='https://files.pythonhosted.org/'||
+        (case when l.path like '%.part' then substr(l.path,1,length(l.path)-5) else l.path end)
+)
+"""
+    for path, size in db.execute(sql).fetchall():
+        removed_files += 1
+        removed_size += size
+        if not dry_run:
+            (web_root / path).unlink(missing_ok=True)
+            db.execute("delete from local_file where path=?", (path,))
+        logger.debug(f"unlink orphan {path}")
+    db.commit()
 
     logger.info(f"files removed: {removed_files}")
     logger.info(
@@ -1001,7 +3625,7 @@ def run(update=False, metadata=False, packages=False, **kwargs):
     if kwargs["test"]:
         pypi_uri = "https://test.pypi.org/pypi"
 
-    db = sqlite3.connect(kwargs["db"])
+    db = connect(kwargs["db"])
     client = xmlrpc.client.ServerProxy(pypi_uri)
 
     create_db(db, use_meta_db)
@@ -1010,6 +3634,10 @@ def run(update=False, metadata=False, packages=False, **kwargs):
     dry_run = kwargs["dry_run"]
     no_index = kwargs["no_index"]
     keep_releases = kwargs["keep_releases"]
+    jobs = kwargs["jobs"]
+    environments = TargetEnvironments(
+        kwargs["python"] or TARGET_PYTHONS, kwargs["machine"] or TARGET_MACHINES
+    )
 
     whitelist = kwargs["add"]
     for fn in kwargs["add_list"]:
@@ -1018,8 +3646,30 @@ def run(update=False, metadata=False, packages=False, **kwargs):
             for r in fp:
                 whitelist.append(r.strip())
 
+    if kwargs["rescan"]:
+        rescan_local_files(db, web_root, jobs)
+
+    if kwargs["reset_progress"]:
+        import_progress(db, web_root)
+        reset_progress(db)
+    elif kwargs["redo"]:
+        import_progress(db, web_root)
+        reset_progress(db, kwargs["redo"])
+
     if kwargs["remove_orphans"]:
-        remove_orphans(db, web_root, dry_run)
+        remove_orphans(db, web_root, dry_run, jobs)
+
+    elif kwargs["recompress"]:
+        recompress_metadata(db)
+
+    elif kwargs["reindex"]:
+        reindex_packages(db, web_root, dry_run, jobs)
+
+    elif kwargs["why"]:
+        graph = DependencyGraph(db, environments)
+        graph.exclude(get_blacklist(db)[0])
+        for name in kwargs["why"]:
+            print(explain_exclusion(graph, name))
 
     elif kwargs["remove_unwanted"]:
         only_wl = len(whitelist) != 0
@@ -1033,27 +3683,51 @@ def run(update=False, metadata=False, packages=False, **kwargs):
             keep_releases,
             True,
             False,
+            environments=environments,
         )
 
     elif not update and not metadata and not packages:
-        logger.warning("nothing to do, did you mess up -u, -m, -p ?")
+        if not (kwargs["rescan"] or kwargs["reset_progress"] or kwargs["redo"]):
+            logger.warning("nothing to do, did you mess up -u, -m, -p ?")
     else:
         if update:
             logger.info("*** update project list ***")
-            update_list(client, db)
+            update_list(client, db, full_refresh=kwargs["full_update"])
 
         if metadata:
             if kwargs["whitelist"]:
                 logger.info("*** download metadata (whitelist) ***")
-                download_metadata(db, use_meta_db, pypi_uri, whitelist)
+                # the metadata of the dependencies give their own dependencies
+                wanted = whitelist
+                known = set()
+                while wanted:
+                    download_metadata(
+                        db,
+                        use_meta_db,
+                        pypi_uri,
+                        wanted,
+                        jobs,
+                        kwargs["commit_count"],
+                        kwargs["commit_interval"],
+                    )
+                    closure = whitelist_closure(db, whitelist, environments)
+                    wanted = sorted(set(closure) - known)
+                    known.update(closure)
             else:
                 logger.info("*** download metadata ***")
-                download_metadata(db, use_meta_db, pypi_uri)
+                download_metadata(
+                    db,
+                    use_meta_db,
+                    pypi_uri,
+                    None,
+                    jobs,
+                    kwargs["commit_count"],
+                    kwargs["commit_interval"],
+                )
 
-            # remove the file where we save the download progress
-            z = web_root / "done"
-            if z.exists():
-                z.unlink()
+            # start a new mirroring pass
+            import_progress(db, web_root)
+            reset_progress(db)
 
         if packages:
             logger.info("*** download packages ***")
@@ -1067,8 +3741,12 @@ def run(update=False, metadata=False, packages=False, **kwargs):
                 keep_releases,
                 False,
                 not kwargs["force"],
+                jobs,
+                not kwargs["force"],
+                environments,
             )
 
+    checkpoint(db)
     db.close()
 
 
@@ -1088,6 +3766,12 @@ def run(update=False, metadata=False, packages=False, **kwargs):
 @click.option(
     "-u", "--update", is_flag=True, default=False, help="update list of projects"
 )
+@click.option(
+    "--full-update",
+    is_flag=True,
+    default=False,
+    help="refresh the whole list of projects instead of applying the changelog",
+)
 @click.option(
     "-m", "--metadata", is_flag=True, default=False, help="download JSON metadata"
 )
@@ -1119,12 +3803,36 @@ def run(update=False, metadata=False, packages=False, **kwargs):
     "--db", help="packages database", type=click.Path(file_okay=True), show_default=True
 )
 @click.option("--remove-orphans", is_flag=True, help="find and remove orphan files")
+@click.option(
+    "--why", multiple=True, help="explain why a project is excluded from the mirror"
+)
 @click.option("--remove-unwanted", is_flag=True, help="find and remove unwanted files")
+@click.option(
+    "--rescan", is_flag=True, help="update the inventory of the files of the mirror"
+)
+@click.option(
+    "--reset-progress",
+    is_flag=True,
+    help="start a new mirroring pass instead of resuming the current one",
+)
+@click.option(
+    "--redo", multiple=True, help="project to process again in the current pass"
+)
 @click.option(
     "--raw", is_flag=True, help="store raw JSON metadata in a separated database"
 )
+@click.option(
+    "--recompress",
+    is_flag=True,
+    help="train a new dictionary and compress again the raw JSON metadata",
+)
 @click.option("--test", is_flag=True, help="use test.pypi.org")
 @click.option("--no-index", is_flag=True, help="do not create /simple/xxx/index.html")
+@click.option(
+    "--reindex",
+    is_flag=True,
+    help="write again the changed /simple/xxx/index.html pages",
+)
 @click.option(
     "-k",
     "--keep-releases",
@@ -1134,7 +3842,41 @@ def run(update=False, metadata=False, packages=False, **kwargs):
     show_default=True,
 )
 @click.option(
-    "--force", is_flag=True, help="do not use/save progress when mirroring packages"
+    "--python",
+    multiple=True,
+    help=f"python version of the clients  [default: {', '.join(TARGET_PYTHONS)}]",
+)
+@click.option(
+    "--machine",
+    multiple=True,
+    help=f"machine of the clients  [default: {', '.join(TARGET_MACHINES)}]",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    help="do not use/save progress when mirroring packages, process all the packages",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    default=8,
+    help="maximum concurrent downloads of metadata and files",
+    type=click.IntRange(min=1),
+    show_default=True,
+)
+@click.option(
+    "--commit-count",
+    default=1000,
+    help="commit the metadata every N packages",
+    type=click.IntRange(min=1),
+    show_default=True,
+)
+@click.option(
+    "--commit-interval",
+    default=60,
+    help="commit the metadata every N seconds",
+    type=click.IntRange(min=1),
+    show_default=True,
 )
 def main(**kwargs):
     """
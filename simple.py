@@ -7,14 +7,13 @@ Simple HTTP server that mimics https://pypi.org/simple/
 import tornado.ioloop
 import tornado.web
 import tornado.log
-import sqlite3
 from packaging.utils import canonicalize_name  # lowercase, only hyphen PEP503
 import logging
 from collections import defaultdict, OrderedDict
 import pathlib
 import click
 import time
-from pypim import build_index
+from pypim import build_index, connect, fetch_value, local_files, url_path
 
 
 # cache system for index.html
@@ -29,9 +28,10 @@ class SimpleHandler(tornado.web.RequestHandler):
     returns the releases files list
     """
 
-    def initialize(self, database, path):
+    def initialize(self, database, path, inventory):
         self.db = database
         self.path = path
+        self.inventory = inventory
 
     def get(self, name):
 
@@ -51,19 +51,24 @@ class SimpleHandler(tornado.web.RequestHandler):
             cur = self.db.cursor()
 
             r = cur.execute(
-                "select name,last_serial from package where name=?", (name,)
+                "select id,name,last_serial from package where name=?", (name,)
             ).fetchone()
             if r is None:
                 # tornado.log.gen_log.error(f"project {name} not found in index")
                 raise tornado.web.HTTPError(403)
 
-            name, last_serial = r
+            package_id, name, last_serial = r
 
             tornado.log.gen_log.info(f"serving {name} {last_serial}")
 
             releases = defaultdict(list)
-            sql = "select release,filename,url,size,requires_python,sha256_digest from file where name=?"
-            for row in cur.execute(sql, (name,)):
+            sql = """\
+select r.release,f.filename,f.url,f.size,f.requires_python,f.sha256_digest
+from release as r join file as f on f.release_id=r.id
+where r.package_id=?
+order by r.sort_key,f.id
+"""
+            for row in cur.execute(sql, (package_id,)):
                 releases[row[0]].append(
                     {
                         "filename": row[1],
@@ -74,7 +79,15 @@ class SimpleHandler(tornado.web.RequestHandler):
                     }
                 )
 
-            html = build_index(name, last_serial, releases, self.path)
+            # the files of the mirror, from the local_file inventory if built
+            present = None
+            if self.inventory:
+                present = local_files(
+                    self.db,
+                    [url_path(f["url"]) for r in releases.values() for f in r],
+                )
+
+            html = build_index(name, last_serial, releases, self.path, present)
 
             self.write(html)
 
@@ -117,11 +130,20 @@ def main(verbose, port, web, db):
     else:
         db = pathlib.Path(db).expanduser()
 
-    database = sqlite3.connect(f"file:{db}?mode=ro", uri=True)
+    database = connect(db, "reader")
+
+    # without inventory (see rescan_local_files), build_index checks the disk
+    inventory = fetch_value(
+        database, "select value from sync_state where key='local_file_scan'"
+    )
 
     app = tornado.web.Application(
         [
-            (r"/simple/([^/]+)/?", SimpleHandler, {"database": database, "path": path}),
+            (
+                r"/simple/([^/]+)/?",
+                SimpleHandler,
+                {"database": database, "path": path, "inventory": inventory},
+            ),
             (
                 r"/(packages/.*)",
                 tornado.web.StaticFileHandler,
@@ -0,0 +1,127 @@
+import io
+import json
+import os
+import random
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import pypim  # noqa: E402
+
+
+def random_metadata(rng, name, last_serial):
+    releases = dict()
+    for release in rng.sample(["0.9", "1.0", "1.1", "2.0rc1", "2.0", "10.0"], 4):
+        releases[release] = []
+
+    # a file may move from a release to another
+    for i in rng.sample(range(8), 5):
+        filename = f"{name}-{i}.tar.gz"
+        releases[rng.choice(list(releases))].append(
+            {
+                "filename": filename,
+                "url": f"https://files.pythonhosted.org/packages/{filename}",
+                "size": rng.choice((1, 2, 1000)),
+                "digests": {"sha256": rng.choice("01") * 64},
+                "packagetype": rng.choice(("sdist", "bdist_wheel")),
+                "requires_python": rng.choice((None, ">=3.8")),
+                "has_sig": rng.choice((False, True)),
+                "upload_time": "2020-01-01T00:00:00",
+            }
+        )
+
+    return {
+        "info": {
+            "name": name,
+            "version": rng.choice(list(releases)),
+            "summary": rng.choice((None, "a", "b")),
+            "classifiers": rng.sample(["A :: 1", "A :: 2", "B :: 1", "C"], 2),
+            "requires_dist": rng.choice(
+                (None, [], ["bar>=1"], ["bar>=1", "baz; extra == 'x'"], ["bar<2"])
+            ),
+        },
+        "last_serial": last_serial,
+        "releases": releases,
+    }
+
+
+def snapshot(db):
+    """
+    the content of the catalog, without the integer keys
+    """
+    packages = dict()
+    for (name,) in db.execute("select name from package"):
+        row = db.execute(
+            f"select {','.join(pypim.PACKAGE_COLUMNS)} from package where name=?",
+            (name,),
+        ).fetchone()
+        sort_keys = db.execute(
+            "select r.release,r.sort_key from release as r "
+            "join package as p on p.id=r.package_id where p.name=?",
+            (name,),
+        ).fetchall()
+        requires_dist = db.execute(
+            "select r.requires_dist,r.name,r.specifier,r.marker,r.extra,r.error "
+            "from requires_dist as r join package as p on p.id=r.package_id "
+            "where p.name=? order by r.rowid",
+            (name,),
+        ).fetchall()
+        packages[name] = (
+            row,
+            pypim.stored_package(db, name),
+            sorted(sort_keys),
+            requires_dist,
+        )
+    # no orphan rows
+    counts = [
+        db.execute(f"select count(*) from {table}").fetchone()[0]
+        for table in ("package_classifier", "requires_dist", "release", "file")
+    ]
+    return packages, counts
+
+
+def new_db():
+    db = sqlite3.connect(":memory:")
+    pypim.create_db(db, False)
+    return db
+
+
+def test_add_package_diff():
+    rng = random.Random(8)
+
+    bulk_db, direct_db, streamed_db = new_db(), new_db(), new_db()
+    bulk = pypim.BulkWriter(bulk_db)
+
+    for serial in range(1, 60):
+        documents = dict(
+            (name, random_metadata(rng, name, serial)) for name in ("foo", "bar")
+        )
+
+        for name, metadata in documents.items():
+            data = json.dumps(metadata).encode()
+            pypim.add_package(bulk_db, name, data, False, bulk)
+            pypim.add_package(direct_db, name, data, False)
+            pypim.add_package(streamed_db, name, io.BytesIO(data), False)
+
+        # the same package twice in a batch
+        if serial % 3 == 0:
+            metadata = random_metadata(rng, "foo", serial)
+            documents["foo"] = metadata
+            data = json.dumps(metadata).encode()
+            pypim.add_package(bulk_db, "foo", data, False, bulk)
+            pypim.add_package(direct_db, "foo", data, False)
+            pypim.add_package(streamed_db, "foo", io.BytesIO(data), False)
+
+        if serial % 2 == 0:
+            assert bulk.flush() == []
+
+        # the updated packages are stored like new packages
+        if serial % 2 == 0:
+            fresh_db = new_db()
+            for name, metadata in documents.items():
+                pypim.add_package(fresh_db, name, json.dumps(metadata).encode(), False)
+            expected = snapshot(fresh_db)
+            assert snapshot(bulk_db) == expected
+            assert snapshot(direct_db) == expected
+            assert snapshot(streamed_db) == expected
@@ -0,0 +1,70 @@
+import json
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import pypim  # noqa: E402
+
+
+def metadata(name, last_serial, requires_dist):
+    return json.dumps(
+        {
+            "info": {
+                "name": name,
+                "version": "1.0",
+                "requires_dist": requires_dist,
+                "classifiers": [],
+            },
+            "last_serial": last_serial,
+            "releases": {
+                "1.0": [
+                    {
+                        "filename": f"{name}-1.0.tar.gz",
+                        "url": f"https://files.pythonhosted.org/packages/{name}-1.0.tar.gz",
+                        "size": 1,
+                        "digests": {"sha256": "0" * 64},
+                    }
+                ]
+            },
+        }
+    ).encode()
+
+
+def update(db, name, last_serial, requires_dist):
+    bulk = pypim.BulkWriter(db)
+    pypim.add_package(db, name, metadata(name, last_serial, requires_dist), False, bulk)
+    assert bulk.flush() == []
+
+
+def test_update_package_twice():
+    db = sqlite3.connect(":memory:")
+    pypim.create_db(db, False)
+
+    # nothing is logged until there are derived data to update
+    update(db, "foo", 1, ["bar>=1"])
+    assert db.execute("select count(*) from package_change").fetchone() == (0,)
+    assert db.execute("select count(*) from requirement_change").fetchone() == (0,)
+
+    blacklist, conditions = pypim.get_requirements(db, pypim.TargetEnvironments())
+    assert conditions == {"bar": {">=1"}}
+
+    # the changes of the package are logged once, until get_requirements
+    update(db, "foo", 2, ["bar>=2"])
+    update(db, "foo", 3, ["bar>=2"])
+
+    assert db.execute("select last_serial from package").fetchall() == [(3,)]
+    assert db.execute("select name from package_change").fetchall() == [("foo",)]
+    assert db.execute(
+        "select specifier,sum(delta) from requirement_change group by specifier"
+    ).fetchall() == [(">=1", -1), (">=2", 1)]
+
+    blacklist, conditions = pypim.get_requirements(db, pypim.TargetEnvironments())
+    assert conditions == {"bar": {">=2"}}
+    assert db.execute("select count(*) from package_change").fetchone() == (0,)
+
+    update(db, "foo", 4, [])
+    update(db, "foo", 5, [])
+    blacklist, conditions = pypim.get_requirements(db, pypim.TargetEnvironments())
+    assert conditions == {}
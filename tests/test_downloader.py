@@ -0,0 +1,212 @@
+import hashlib
+import io
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import pypim  # noqa: E402
+
+
+class FakeRaw:
+    def __init__(self, data):
+        self.fp = io.BytesIO(data)
+
+    def read1(self, size, decode_content=True):
+        return self.fp.read(min(size, 3))
+
+
+class FakeResponse:
+    def __init__(self, data, status_code=200, headers=None):
+        self.raw = FakeRaw(data)
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.headers = headers or {}
+
+
+def serve(content, requests=None):
+    """
+    a stub of http_get that serves the content by url, with the Range requests
+    """
+
+    def http_get(session, url, read, retries=6, limiter=None, ctrl_c=None, **kwargs):
+        headers = kwargs.get("headers") or {}
+        if requests is not None:
+            requests.append((url, dict(headers)))
+        data = content[url]
+        m = re.match(r"bytes=(\d+)-", headers.get("Range", ""))
+        if m:
+            offset = int(m.group(1))
+            headers = {"Content-Range": f"bytes {offset}-{len(data) - 1}"}
+            return read(FakeResponse(data[offset:], 206, headers))
+        return read(FakeResponse(data))
+
+    return http_get
+
+
+def package(name, content):
+    """
+    the JSON metadata of a package with a release holding the files of content
+    """
+    return json.dumps(
+        {
+            "info": {
+                "name": name,
+                "version": "1.0",
+                "requires_dist": None,
+                "classifiers": [],
+            },
+            "last_serial": 1,
+            "releases": {
+                "1.0": [
+                    {
+                        "filename": url.rsplit("/", 1)[1],
+                        "url": url,
+                        "size": len(data),
+                        "digests": {"sha256": hashlib.sha256(data).hexdigest()},
+                    }
+                    for url, data in content.items()
+                ]
+            },
+        }
+    ).encode()
+
+
+def test_interrupt_while_submitting(tmp_path, monkeypatch):
+    content = dict(
+        (f"https://files.pythonhosted.org/packages/big-{i}.tar.gz", b"x" * (i + 1))
+        for i in range(3)
+    )
+    monkeypatch.setattr(pypim, "http_get", serve(content))
+
+    # Ctrl-C while the second file of the package is submitted, the first one done
+    submit = pypim.Downloader.submit
+    submitted = []
+
+    def interrupted_submit(self, *args, **kwargs):
+        if submitted:
+            self.executor.shutdown(wait=True)
+            raise KeyboardInterrupt
+        submitted.append(args)
+        submit(self, *args, **kwargs)
+
+    monkeypatch.setattr(pypim.Downloader, "submit", interrupted_submit)
+
+    db_path = tmp_path / "pypi.db"
+    db = sqlite3.connect(db_path)
+    pypim.create_db(db, False)
+    pypim.add_package(db, "big", package("big", content), False)
+    db.commit()
+
+    pypim.download_packages(db, tmp_path, keep_releases=0, jobs=1)
+    db.close()
+
+    # the finished download is committed, the package is not mirrored
+    db = sqlite3.connect(db_path)
+    assert db.execute("select path,size from local_file").fetchall() == [
+        ("packages/big-0.tar.gz", 1)
+    ]
+    assert db.execute("select count(*) from mirrored_package").fetchone() == (0,)
+    assert db.execute("select count(*) from progress").fetchone() == (0,)
+    assert (tmp_path / "packages" / "big-0.tar.gz").read_bytes() == b"x"
+
+
+def download(tmp_path, content, sha256=None):
+    """
+    download the files of content with one Downloader, returns the results
+    """
+    downloader = pypim.Downloader(2)
+    for url, data in content.items():
+        filename = tmp_path / url.rsplit("/", 1)[1]
+        downloader.submit(url, url, filename, len(data), sha256)
+    downloader.close()
+    return downloader.results()
+
+
+def test_sha256_mismatch(tmp_path, monkeypatch):
+    url = "https://files.pythonhosted.org/packages/foo.tar.gz"
+    monkeypatch.setattr(pypim, "http_get", serve({url: b"corrupted"}))
+
+    ((key, error),) = download(tmp_path, {url: b"corrupted"}, "0" * 64)
+
+    assert isinstance(error, pypim.TransientError)
+    assert "sha256 mismatch" in str(error)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_size_mismatch(tmp_path, monkeypatch):
+    url = "https://files.pythonhosted.org/packages/foo.tar.gz"
+    monkeypatch.setattr(pypim, "http_get", serve({url: b"short"}))
+
+    downloader = pypim.Downloader(1)
+    downloader.submit(url, url, tmp_path / "foo.tar.gz", 100)
+    downloader.close()
+    ((key, error),) = downloader.results()
+
+    assert "size mismatch" in str(error)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_resume(tmp_path, monkeypatch):
+    url = "https://files.pythonhosted.org/packages/foo.tar.gz"
+    data = b"0123456789" * 10
+    requests = []
+    monkeypatch.setattr(pypim, "http_get", serve({url: data}, requests))
+
+    # the part of an interrupted download
+    (tmp_path / "foo.tar.gz.part").write_bytes(data[:42])
+
+    sha256 = hashlib.sha256(data).hexdigest()
+    assert download(tmp_path, {url: data}, sha256) == [(url, None)]
+
+    assert requests == [(url, {"Range": "bytes=42-"})]
+    assert (tmp_path / "foo.tar.gz").read_bytes() == data
+    assert not (tmp_path / "foo.tar.gz.part").exists()
+
+
+def test_resume_complete_part(tmp_path, monkeypatch):
+    url = "https://files.pythonhosted.org/packages/foo.tar.gz"
+    data = b"0123456789"
+    requests = []
+    monkeypatch.setattr(pypim, "http_get", serve({url: data}, requests))
+
+    # a part as large as the file is downloaded again
+    (tmp_path / "foo.tar.gz.part").write_bytes(b"9876543210")
+
+    assert download(tmp_path, {url: data}) == [(url, None)]
+    assert requests == [(url, {})]
+    assert (tmp_path / "foo.tar.gz").read_bytes() == data
+
+
+def test_cancel(tmp_path, monkeypatch):
+    content = dict(
+        (f"https://files.pythonhosted.org/packages/foo-{i}.tar.gz", b"x")
+        for i in range(4)
+    )
+    started = threading.Event()
+    release = threading.Event()
+    http_get = serve(content)
+
+    def blocking_http_get(session, url, read, **kwargs):
+        started.set()
+        release.wait(10)
+        return http_get(session, url, read, **kwargs)
+
+    monkeypatch.setattr(pypim, "http_get", blocking_http_get)
+
+    downloader = pypim.Downloader(1)
+    for url in content:
+        downloader.submit(url, url, tmp_path / url.rsplit("/", 1)[1], 1)
+    started.wait(10)
+
+    # the download in progress is finished, the queued ones are cancelled
+    threading.Timer(0.2, release.set).start()
+    downloader.close(cancel=True)
+
+    url = next(iter(content))
+    assert downloader.results() == [(url, None)]
+    assert [i.name for i in tmp_path.iterdir()] == ["foo-0.tar.gz"]
@@ -0,0 +1,166 @@
+import email.utils
+import io
+import os
+import sys
+import time
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import pypim  # noqa: E402
+
+
+class FakeRaw:
+    def __init__(self, data, delay=0):
+        self.fp = io.BytesIO(data)
+        self.delay = delay
+
+    def read1(self, size, decode_content=True):
+        time.sleep(self.delay)
+        return self.fp.read(min(size, 1 if self.delay else size))
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None, data=b"", delay=0):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.headers = headers or {}
+        self.raw = FakeRaw(data, delay)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError(f"HTTP {self.status_code}", response=self)
+
+
+class FakeSession:
+    """
+    returns the responses in order, raises the exceptions
+    """
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.attempts = 0
+
+    def get(self, url, **kwargs):
+        self.attempts += 1
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def read(response):
+    return b"".join(pypim.iter_content(response))
+
+
+@pytest.fixture(autouse=True)
+def short_backoff(monkeypatch):
+    monkeypatch.setattr(pypim, "BACKOFF_BASE", 0.001)
+
+
+@pytest.mark.parametrize(
+    "responses, attempts",
+    [
+        ([FakeResponse(200, data=b"ok")], 1),
+        (
+            [
+                FakeResponse(429, {"Retry-After": "0"}),
+                FakeResponse(503, {"Retry-After": "0"}),
+                FakeResponse(200, data=b"ok"),
+            ],
+            3,
+        ),
+        ([FakeResponse(502), FakeResponse(200, data=b"ok")], 2),
+        ([requests.ConnectionError(), FakeResponse(200, data=b"ok")], 2),
+        ([requests.Timeout(), FakeResponse(200, data=b"ok")], 2),
+    ],
+)
+def test_retry(responses, attempts):
+    session = FakeSession(*responses)
+    assert pypim.http_get(session, "https://pypi.org/x", read) == b"ok"
+    assert session.attempts == attempts
+
+
+def test_retry_after():
+    session = FakeSession(
+        FakeResponse(503, {"Retry-After": "0.2"}), FakeResponse(200, data=b"ok")
+    )
+    start = time.monotonic()
+    assert pypim.http_get(session, "https://pypi.org/x", read) == b"ok"
+    assert time.monotonic() - start >= 0.2
+
+
+@pytest.mark.parametrize(
+    "value, delay",
+    [
+        (None, None),
+        ("12", 12.0),
+        ("-1", 0.0),
+        ("soon", None),
+        (email.utils.formatdate(time.time() - 60, usegmt=True), 0.0),
+    ],
+)
+def test_retry_after_header(value, delay):
+    headers = {} if value is None else {"Retry-After": value}
+    assert pypim.retry_after(FakeResponse(503, headers)) == delay
+
+
+def test_retry_after_date():
+    value = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert 50 < pypim.retry_after(FakeResponse(503, {"Retry-After": value})) <= 60
+
+
+def test_retries_exhausted():
+    session = FakeSession(*(FakeResponse(503) for _ in range(3)))
+    with pytest.raises(pypim.TransientError, match="HTTP 503"):
+        pypim.http_get(session, "https://pypi.org/x", read, retries=3)
+    assert session.attempts == 3
+
+
+def test_not_found():
+    session = FakeSession(FakeResponse(404), FakeResponse(200))
+    with pytest.raises(FileNotFoundError):
+        pypim.http_get(session, "https://pypi.org/x", read)
+    assert session.attempts == 1
+
+
+def test_client_error():
+    session = FakeSession(FakeResponse(403), FakeResponse(200))
+    with pytest.raises(requests.HTTPError):
+        pypim.http_get(session, "https://pypi.org/x", read)
+    assert session.attempts == 1
+
+
+def test_transient_error_of_read():
+    session = FakeSession(FakeResponse(200, data=b"ko"), FakeResponse(200, data=b"ok"))
+
+    def check(response):
+        data = read(response)
+        if data != b"ok":
+            raise pypim.TransientError("bad data")
+        return data
+
+    assert pypim.http_get(session, "https://pypi.org/x", check) == b"ok"
+    assert session.attempts == 2
+
+
+def test_stall(monkeypatch):
+    monkeypatch.setattr(pypim, "STALL_PERIOD", 0.05)
+
+    # 1 byte every 10ms: below MIN_THROUGHPUT
+    session = FakeSession(
+        FakeResponse(200, data=b"x" * 100, delay=0.01), FakeResponse(200, data=b"ok")
+    )
+    assert pypim.http_get(session, "https://pypi.org/x", read) == b"ok"
+    assert session.attempts == 2
+
+    with pytest.raises(pypim.TransientError, match="stalled"):
+        read(FakeResponse(200, data=b"x" * 100, delay=0.01))
@@ -0,0 +1,87 @@
+import io
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import pypim  # noqa: E402
+
+
+def random_string(rng):
+    # escapes and multi-byte characters split across the chunks
+    return "".join(rng.choice('ab "\\/\n\té€😀') for _ in range(rng.randrange(12)))
+
+
+def random_value(rng, depth=0):
+    kind = rng.randrange(8 if depth < 4 else 5)
+    if kind == 0:
+        return rng.choice((None, True, False))
+    if kind == 1:
+        return rng.choice((0, -1, 12345678901234567890, rng.randint(-1000, 1000)))
+    if kind == 2:
+        return rng.choice((0.5, -1.25e-7, 1e100, rng.uniform(-1e6, 1e6)))
+    if kind in (3, 4):
+        return random_string(rng)
+    if kind in (5, 6):
+        return dict(
+            (random_string(rng), random_value(rng, depth + 1))
+            for _ in range(rng.randrange(5))
+        )
+    return [random_value(rng, depth + 1) for _ in range(rng.randrange(5))]
+
+
+def random_document(rng):
+    document = dict(
+        (str(rng.random()), random_value(rng, 1)) for _ in range(rng.randrange(4))
+    )
+    document["key"] = random_value(rng)
+    return document
+
+
+def read(stream):
+    """
+    decode the next value, reading the objects with members()
+    """
+    if stream._peek() == "{":
+        return dict((key, read(stream)) for key in stream.members())
+    return stream.value()
+
+
+def encode(document, rng):
+    if rng.random() < 0.5:
+        return json.dumps(document, ensure_ascii=False).encode()
+    return json.dumps(document, indent=rng.choice((None, 1, 4))).encode()
+
+
+def test_json_stream():
+    rng = random.Random(11)
+    for _ in range(300):
+        document = random_document(rng)
+        data = encode(document, rng)
+        for chunk_size in (1, 2, 3, 7, 1 << 16):
+            stream = pypim.JSONStream(io.BytesIO(data), chunk_size)
+            assert read(stream) == json.loads(data)
+            stream = pypim.JSONStream(io.BytesIO(data), chunk_size)
+            assert stream.value() == json.loads(data)
+
+
+def test_read_metadata():
+    rng = random.Random(11)
+    for _ in range(100):
+        metadata = {
+            "info": random_document(rng),
+            "last_serial": rng.randint(1, 1 << 31),
+            "releases": random_document(rng),
+            "urls": random_value(rng),
+        }
+        items = list(metadata.items())
+        rng.shuffle(items)
+        data = encode(dict(items), rng)
+
+        metadata = json.loads(data)
+        info, last_serial, releases = pypim.read_metadata(io.BytesIO(data))
+        assert info == metadata["info"]
+        assert last_serial == metadata["last_serial"]
+        assert dict(releases) == metadata["releases"]
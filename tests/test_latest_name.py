@@ -0,0 +1,87 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from plugins.latest_name import LatestReleaseFilter, required_releases  # noqa: E402
+
+VERSIONS = ["0.9", "1.0", "1.1", "2.0a1", "2.0", "2.1", "3.0b1"]
+
+
+@pytest.mark.parametrize(
+    "conditions, kept, required",
+    [
+        (None, [], []),
+        (set(), [], []),
+        ({"<2"}, [], ["1.1"]),
+        ({"<2"}, ["1.0"], []),
+        ({">=1,<2", "==1.0"}, [], ["1.0"]),
+        ({"<1", ">=2"}, [], ["2.1", "0.9"]),
+        ({"~=2.0", "<2.1"}, [], ["2.0"]),
+        # the pre-releases only if allowed or if no final release satisfies
+        ({">=2"}, [], ["2.1"]),
+        ({">=2.0a1"}, [], ["3.0b1"]),
+        ({">2.1"}, [], ["3.0b1"]),
+        ({"==2.0a1"}, [], ["2.0a1"]),
+        # no release satisfies, the invalid specifiers are ignored
+        ({">=4"}, [], []),
+        ({">=4", "<1"}, [], ["0.9"]),
+        ({"not a specifier"}, [], []),
+    ],
+)
+def test_required_releases(conditions, kept, required):
+    assert required_releases(VERSIONS, conditions, kept) == required
+
+
+def latest(keep, conditions, only_required=False, version="2.1"):
+    f = LatestReleaseFilter()
+    config = {"keep": keep, "only_required": only_required}
+    f.configuration = {"latest_release": config}
+    f.initialize_plugin()
+
+    releases = dict((v, [{"version": v}]) for v in VERSIONS)
+    removed = []
+    f.filter({"version": version}, releases, conditions, removed)
+    # the files of the removed releases are returned
+    assert sorted(i["version"] for i in removed) == sorted(
+        set(VERSIONS) - set(releases)
+    )
+    return list(releases)
+
+
+@pytest.mark.parametrize(
+    "keep, conditions, version, kept",
+    [
+        (0, {"<1"}, "2.1", VERSIONS),
+        (3, None, "3.0b1", ["2.0", "2.1", "3.0b1"]),
+        (10, None, "2.1", VERSIONS),
+        # the current version is never removed
+        (2, None, "1.0", ["1.0", "2.1"]),
+        # the releases required by the dependants are kept too
+        (2, {"<2"}, "2.1", ["1.1", "2.1", "3.0b1"]),
+        (2, {">=2.1"}, "2.1", ["2.1", "3.0b1"]),
+        (1, {">=4"}, "2.1", ["2.1"]),
+    ],
+)
+def test_keep_latest(keep, conditions, version, kept):
+    assert latest(keep, conditions, version=version) == kept
+
+
+@pytest.mark.parametrize(
+    "keep, conditions, version, kept",
+    [
+        # only the releases required by the whitelist closure, keep is ignored
+        (3, {"<2"}, "2.1", ["1.1"]),
+        (0, {"<2"}, "2.1", ["1.1"]),
+        (0, {"<1", ">=2,<2.1"}, "2.1", ["0.9", "2.0"]),
+        # the current version of a package required without specifier
+        (3, set(), "2.1", ["2.1"]),
+        (0, None, "1.0", ["1.0"]),
+        # no release satisfies: the current version
+        (3, {">=4"}, "2.1", ["2.1"]),
+    ],
+)
+def test_only_required(keep, conditions, version, kept):
+    assert latest(keep, conditions, only_required=True, version=version) == kept
@@ -0,0 +1,46 @@
+import os
+import random
+import sys
+
+from packaging.version import Version
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from plugins.latest_name import version_key  # noqa: E402
+
+
+def random_version(rng):
+    version = ""
+    if rng.random() < 0.1:
+        version += f"{rng.randint(1, 12)}!"
+    release = (rng.choice((0, 0, 1, 2, 9, 10, 100)) for _ in range(rng.randint(1, 4)))
+    version += ".".join(map(str, release))
+    if rng.random() < 0.3:
+        version += f"{rng.choice(('a', 'b', 'rc'))}{rng.randint(0, 11)}"
+    if rng.random() < 0.2:
+        version += f".post{rng.randint(0, 11)}"
+    if rng.random() < 0.2:
+        version += f".dev{rng.randint(0, 11)}"
+    if rng.random() < 0.15:
+        local = (rng.choice(("abc", "z", "0", "1", "2", "10")) for _ in range(3))
+        version += "+" + ".".join(local)
+    return version
+
+
+def test_version_key_ordering():
+    rng = random.Random(440)
+    versions = [random_version(rng) for _ in range(2000)]
+
+    for a, b in zip(versions, versions[1:] + versions[:1]):
+        va, vb = Version(a), Version(b)
+        ka, kb = version_key(a), version_key(b)
+        assert (va < vb) == (ka < kb), (a, b)
+        assert (va == vb) == (ka == kb), (a, b)
+
+    assert sorted(versions, key=version_key) == sorted(versions, key=Version)
+
+
+def test_version_key_invalid():
+    # the invalid versions sort before the valid ones
+    assert version_key("foo") < version_key("0.0.dev0") < version_key("0")
+    assert version_key("bar") < version_key("foo")
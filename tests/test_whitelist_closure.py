@@ -0,0 +1,92 @@
+import json
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import pypim  # noqa: E402
+
+# requirements of the packages of the catalog
+CATALOG = {
+    "app": [
+        "lib>=1",
+        "Extra_Dep; extra == 'full'",
+        "win-only; sys_platform == 'win32'",
+        "old; python_version < '3'",
+        "tools[cli]>=2",
+        "not-fetched",
+    ],
+    "lib": ["base"],
+    "base": ["lib<3"],
+    "tools": ["clidep; extra == 'cli'", "guidep; extra == 'gui'"],
+    "extra-dep": ["tools[gui]"],
+    "clidep": [],
+    "guidep": [],
+    "win-only": [],
+    "old": [],
+    "unrelated": ["lib"],
+}
+
+
+@pytest.fixture(scope="module")
+def db():
+    db = sqlite3.connect(":memory:")
+    pypim.create_db(db, False)
+    for name, requires_dist in CATALOG.items():
+        metadata = {
+            "info": {
+                "name": name,
+                "version": "1.0",
+                "requires_dist": requires_dist,
+                "classifiers": [],
+            },
+            "last_serial": 1,
+            "releases": {},
+        }
+        pypim.add_package(db, name, json.dumps(metadata).encode(), False)
+
+    # a package known by the project list, without metadata
+    db.execute("insert into list_packages (name,last_serial) values ('not-fetched',1)")
+    return db
+
+
+BASE = {
+    "app": set(),
+    "lib": {">=1", "<3"},
+    "base": set(),
+    "tools": {">=2"},
+    "clidep": set(),
+    "not-fetched": set(),
+}
+
+
+@pytest.mark.parametrize(
+    "whitelist, closure",
+    [
+        (["app"], BASE),
+        (["app==1.0", "# comment", ""], dict(BASE, app={"==1.0"})),
+        # the extras of the whitelist and of the dependencies are followed
+        (
+            ["app[full]"],
+            dict(BASE, **{"extra-dep": set(), "guidep": set()}),
+        ),
+        (["tools"], {"tools": set()}),
+        (["tools[gui,cli]"], {"tools": set(), "clidep": set(), "guidep": set()}),
+        # the unknown packages and the invalid requirements are ignored
+        (["missing", "lib>=", "base"], {"base": set(), "lib": {"<3"}}),
+        # the markers of the whitelist are evaluated too
+        (["base", "lib; python_version < '3'"], {"base": set(), "lib": {"<3"}}),
+    ],
+)
+def test_whitelist_closure(db, whitelist, closure):
+    environments = pypim.TargetEnvironments()
+    assert pypim.whitelist_closure(db, whitelist, environments) == closure
+
+
+def test_whitelist_closure_without_environments(db):
+    # the markers are not evaluated
+    closure = pypim.whitelist_closure(db, ["app"])
+    assert closure == dict(BASE, **{"win-only": set(), "old": set()})
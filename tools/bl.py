@@ -36,19 +36,32 @@ def main(verbose, web, db):
     else:
         db = os.path.expanduser(db)
 
-    bl = pickle.load(open("blacklist.cache", "rb"))[0]
     conn = sqlite3.connect(db)
+    row = conn.execute(
+        "select data from derived_data where key='requirements'"
+    ).fetchone()
+    if row is None:
+        raise click.ClickException("no blacklist in the database, run pypim -p first")
+    bl = pickle.loads(row[0])["reasons"]
     web = pathlib.Path(web)
 
     total = 0
     count = 0
-    for name, url, size in conn.execute("select name,url,size from file"):
+    removed = set()
+    for name, url, size in conn.execute("select name,url,size from package_file"):
         if name not in bl:
             continue
 
         url = urlparse(url).path[1:]
         path = web / url
+
+        # the inventory of pypim: the file and the state of its package
+        cur = conn.execute("delete from local_file where path=?", (url,))
+        if cur.rowcount:
+            removed.add(name)
+
         if path.exists():
+            removed.add(name)
             path.unlink()
             try:
                 path.parent.rmdir()
@@ -62,6 +75,11 @@ def main(verbose, web, db):
             if verbose:
                 print(f"removed: {path} ({size} bytes)")
 
+    # the packages are processed again by the next mirroring, with their index page
+    for table in ("mirrored_package", "simple_index"):
+        conn.executemany(f"delete from {table} where name=?", ((i,) for i in removed))
+    conn.commit()
+
     print(f"files removed: {count}")
     print(f"space freed: {hf.format_size(total)}")
 
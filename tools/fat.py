@@ -10,7 +10,6 @@ import pathlib
 from urllib.parse import urlparse
 import humanfriendly
 import pickle
-from plugins.blacklist import get_blacklist
 import os.path
 
 
@@ -47,14 +46,16 @@ def pretty(size):
         return str(size)
 
 
-def get_cached_list(filename, getter):
-    f = pathlib.Path(filename + ".cache")
-    if f.is_file():
-        resource = pickle.load(f.open("rb"))
-    else:
-        resource = getter()
-        pickle.dump(resource, f.open("wb"), pickle.HIGHEST_PROTOCOL)
-    return resource
+def get_blacklist(db):
+    """
+    the blacklist with its dependants, as computed by pypim
+    """
+    row = db.execute(
+        "select data from derived_data where key='requirements'"
+    ).fetchone()
+    if row is None:
+        raise click.ClickException("no blacklist in the database, run pypim -p first")
+    return set(pickle.loads(row[0])["reasons"])
 
 
 @click.command(context_settings={"help_option_names": ["-h", "--help"]})
@@ -92,14 +93,14 @@ def main(overall, update, web, db_name, limit):
     db = sqlite3.connect(db_name)
     web = pathlib.Path(web)
 
-    blacklist, _ = get_cached_list("blacklist", lambda: get_blacklist(db))
+    blacklist = get_blacklist(db)
 
     if update:
         db_file.execute("drop table if exists file")
         db_file.execute("create table file (name,version,size integer,filename)")
 
         for name, version, size, url, filename in db.execute(
-            "select name,release,size,url,filename from file"
+            "select name,release,size,url,filename from package_file"
         ):
             url = urlparse(url).path[1:]
             path = web / url
@@ -7,19 +7,21 @@ Populate sha256_digest column with the JSON metadata field
 
 import sqlite3
 import json
+from pypim import MetadataCodec
 
 
 db = sqlite3.connect("pypi_json.db")
 db.execute("attach database ? as Z", ("pypi.db",))
+codec = MetadataCodec(db, "main")
 count = 0
 
 for row in db.execute("select name,metadata from package"):
     name = row[0]
-    for release, files in json.loads(row[1])["releases"].items():
+    for release, files in json.loads(codec.decompress(row[1]))["releases"].items():
         for file in files:
             r = db.execute(
-                "update Z.file set sha256_digest=? where name=? and release=? and filename=? and sha256_digest is null",
-                (file["digests"]["sha256"], name, release, file["filename"]),
+                "update Z.file set sha256_digest=? where url=? and sha256_digest is null",
+                (file["digests"]["sha256"], file["url"]),
             )
             # assert r.rowcount == 1
 